@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
+import hashlib
 import logging
 import ujson as json
 
@@ -9,6 +11,9 @@ import tornado.ioloop
 import tornado.httpserver
 import tornado.gen
 import tornado.httpclient
+import tornado.locks
+import tornado.netutil
+import tornado.iostream
 
 from signal import signal, SIGTERM, SIGQUIT, SIGINT
 try:
@@ -16,155 +21,443 @@ try:
 except ImportError:
     from urllib.parse import urlparse
 
-from ServiceDiscovery.discovery import Service, ServiceDiscovery
+from ServiceDiscovery.discovery import ServiceDiscovery, Service
+from ServiceDiscovery.cache import TTLCache
+from ServiceDiscovery.controllers import (ConfigHandler, MetricsHandler,
+                                          log_request)
+from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery, is_timeout
 from ServiceDiscovery.config import config as _config
-from ServiceDiscovery.stats import StatsHandler
+from ServiceDiscovery.stats import StatsHandler, StatsSampler
+from ServiceDiscovery.events import CatalogEvents, WatchHandler
+from ServiceDiscovery.shared import SharedCatalog
+from ServiceDiscovery.supervisor import (Supervisor, DrainingApplication,
+                                         drain)
 
 from tornado.options import parse_command_line
 
 config = _config()
 log = logging.getLogger(__name__)
 
+# filtered /services responses cached at once
+MAX_FILTERED = 64
+NDJSON = 'application/x-ndjson'
+# backends detailed in Server-Timing, the slowest ones: proxies reject
+# big headers
+MAX_TIMINGS = 5
+
+
+def server_timing(timings, slowest=MAX_TIMINGS):
+    """Server-Timing of the fetches of /services from `timings`, url ->
+    seconds: how many backends and the slowest fetch, then the
+    `slowest` slowest backends"""
+    if not timings:
+        return None
+    ranked = sorted(timings.items(), key=lambda x: x[1], reverse=True)
+    ret = ['backends;desc="{} backends";dur={:.1f}'.format(
+        len(ranked), ranked[0][1] * 1000)]
+    ret.extend(
+        'config;desc="{}";dur={:.1f}'.format(url, elapsed * 1000)
+        for url, elapsed in ranked[:slowest])
+    return ', '.join(ret)
+
+
+class ConfigFetcher(object):
+    """Fetches /config of every instance of every service concurrently,
+    at most `concurrency` at a time. `sd` is an AsyncServiceDiscovery"""
+
+    def __init__(self, sd, http_client=None, concurrency=None, timeout=None):
+        if concurrency is None:
+            concurrency = config.getint('ServiceDiscovery',
+                                        'fetch_concurrency')
+        if timeout is None:
+            timeout = config.getfloat('ServiceDiscovery', 'fetch_timeout')
+        self.sd = sd
+        self._http_client = http_client
+        self.semaphore = tornado.locks.Semaphore(concurrency)
+        self.timeout = timeout
+        # config url -> (etag, config) of the last answer of backends
+        self.configs = TTLCache(ttl=float('inf'))
+
+    @property
+    def http_client(self):
+        """the shared AsyncHTTPClient, looked up on first use so that it
+        belongs to the IOLoop of the (possibly forked) worker"""
+        if self._http_client is None:
+            self._http_client = tornado.httpclient.AsyncHTTPClient()
+        return self._http_client
 
-class ServiceHandler(tornado.web.RequestHandler):
-    """Handles all discovery messages via REST API"""
+    @tornado.gen.coroutine
+    def fetch(self, url):
+        """returns (config, seconds) of the instance at `url`; config is
+        'Timeout' or 'None' when the fetch fails.
+
+        Requests are conditional: a backend answering 304 has the
+        config it sent last time"""
+        parsed_url = urlparse(url)
+        config_url = "{}://{}/{}".format(
+            parsed_url.scheme,
+            parsed_url.netloc,
+            "config")
+        cached = self.configs.get(config_url)
+        headers = {'If-None-Match': cached[0]} if cached else None
+        with (yield self.semaphore.acquire()):
+            start = time.time()
+            try:
+                res = yield self.http_client.fetch(
+                    config_url,
+                    headers=headers,
+                    validate_cert=False,
+                    request_timeout=self.timeout,
+                    raise_error=False)
+                if res.code == 304 and cached:
+                    data = cached[1]
+                else:
+                    res.rethrow()
+                    log.debug("body: %s", res.body)
+                    data = list(json.loads(res.body).values())[0]
+                    etag = res.headers.get('Etag')
+                    if etag:
+                        self.configs.set(config_url, (etag, data))
+                    else:
+                        self.configs.invalidate(config_url)
+            except Exception as e:
+                if is_timeout(e):
+                    log.warning("Timeout fetching %s", config_url)
+                    data = 'Timeout'
+                else:
+                    log.debug("Failed fetching %s: %s", config_url, e)
+                    data = 'None'
+            elapsed = time.time() - start
+        raise tornado.gen.Return((data, elapsed))
 
-    def initialize(self):
-        self.sd = ServiceDiscovery(endpoint=os.environ.get('SD', 'http://localhost:8500'))
+    @tornado.gen.coroutine
+    def targets(self, tags=(), node=None):
+        """(service_name, url) of every known instance having all of
+        `tags`, and on `node` if given"""
+        names = yield self.sd.listServices()
+        urls = yield [self.sd.getServices(name, tags, node)
+                      for name in names]
+        raise tornado.gen.Return([
+            (service_name, url)
+            for service_name, service_urls in zip(names, urls)
+            for url in service_urls
+        ])
 
-    @classmethod
-    def routes(cls):
-        return [
-            (r'/services/(.*)', cls),
-            (r'/services/', cls),
-            (r'/services', cls)
-        ]
+    @tornado.gen.coroutine
+    def fetch_all(self, tags=(), node=None):
+        """returns ({netloc: {service_name: {url: config}}}, timings)
+        where timings maps every url to its fetch time in seconds, for
+        the `targets` having all of `tags`, and on `node` if given"""
+        targets = yield self.targets(tags, node)
+        ret = dict()
+        timings = dict()
+        if not targets:
+            raise tornado.gen.Return((ret, timings))
+
+        waiter = tornado.gen.WaitIterator(
+            *[self.fetch(url) for _, url in targets])
+        while not waiter.done():
+            data, elapsed = yield waiter.next()
+            service_name, url = targets[waiter.current_index]
+            log.debug("Found %s for %s", url, service_name)
+            netloc = urlparse(url).netloc
+            ret.setdefault(netloc, dict())[service_name] = {url: data}
+            timings[url] = elapsed
+        raise tornado.gen.Return((ret, timings))
+
+
+class ResponseCache(object):
+    """Pre-serialized /services response and its ETag, kept `ttl`
+    seconds.
+
+    Once expired the stale copy is still served while a single
+    background refresh rebuilds it. The response for instances having
+    all of `tags`, and on `node` if given, is cached apart, see
+    `filtered`."""
+
+    def __init__(self, fetcher, ttl=None, tags=(), node=None):
+        if ttl is None:
+            ttl = config.getfloat('ServiceDiscovery', 'services_ttl')
+        self.fetcher = fetcher
+        self.ttl = ttl
+        self.tags = tags
+        self.node = node
+        self.body = None
+        self.etag = None
+        self.timing = None
+        self.updated = None
+        self._refreshing = None
+        # least recently used filters are dropped
+        self._filtered = TTLCache(maxsize=MAX_FILTERED, ttl=float('inf'))
+
+    def filtered(self, tags=(), node=None):
+        """the ResponseCache of the instances having all of `tags`, and
+        on `node` if given"""
+        key = (tuple(sorted(set(tags))), node)
+        if key == ((), None):
+            return self
+        cache = self._filtered.get(key)
+        if cache is None:
+            cache = ResponseCache(self.fetcher, self.ttl, *key)
+            self._filtered.set(key, cache)
+        return cache
+
+    @property
+    def age(self):
+        """seconds since the cached body was built"""
+        if self.updated is None:
+            return None
+        return time.time() - self.updated
+
+    @property
+    def refreshing(self):
+        return self._refreshing is not None and not self._refreshing.done()
+
+    def refresh(self):
+        """rebuilds the body; concurrent callers share the same refresh"""
+        if not self.refreshing:
+            self._refreshing = self._refresh()
+        return self._refreshing
+
+    @tornado.gen.coroutine
+    def _refresh(self):
+        ret, timings = yield self.fetcher.fetch_all(self.tags, self.node)
+        log.debug("About to cache: %s", str(ret))
+        body = json.dumps(ret).encode('utf-8')
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        self.body = body
+        self.timing = server_timing(timings)
+        self.updated = time.time()
+
+    @tornado.gen.coroutine
+    def _refresh_in_background(self):
+        try:
+            yield self.refresh()
+        except Exception:
+            log.exception("Background refresh of /services failed")
+
+    @tornado.gen.coroutine
+    def get(self):
+        """returns the cached body and how it was served: 'HIT',
+        'STALE' (a refresh is running) or 'MISS'"""
+        if self.body is None:
+            yield self.refresh()
+            raise tornado.gen.Return('MISS')
+        if self.age > self.ttl:
+            if not self.refreshing:
+                tornado.ioloop.IOLoop.current().spawn_callback(
+                    self._refresh_in_background)
+            raise tornado.gen.Return('STALE')
+        raise tornado.gen.Return('HIT')
+
+
+class BatchHandler(tornado.web.RequestHandler):
+    """Registers and unregisters services in bulk:
+
+        POST /services/batch
+        {"register": [{"name": ..., "addr": ..., "port": ...}, ...],
+         "unregister": [...], "tags": [...], "txn": false}
+
+    answers with the outcome of every item, in the same order"""
+
+    def initialize(self, sd):
+        self.sd = sd
 
     def set_default_headers(self):
         # this is a JSON RESTful API
         self.set_header('Content-Type', 'application/json')
 
+    def _services(self, items):
+        try:
+            return [Service(x['name'], x['addr'], int(x['port']),
+                            x.get('node'))
+                    for x in items]
+        except (KeyError, TypeError, ValueError) as e:
+            raise tornado.web.HTTPError(400, 'bad service: %s', e)
+
+    @staticmethod
+    def _outcome(results):
+        return [
+            {'id': service.id, 'ok': True} if error is None else
+            {'id': service.id, 'ok': False, 'error': str(error)}
+            for service, error in results
+        ]
+
     @tornado.gen.coroutine
-    def get(self, id=None):
-        ret = dict()
-        for service_name, urls in self.sd.services.iteritems():
-            log.debug("Found %s", service_name)
-            for url in urls:
-                log.debug("Found %s for %s", url, service_name)
-                parsed_url = urlparse(url)
-                config_url = "{}://{}/{}".format(
-                    parsed_url.scheme,
-                    parsed_url.netloc,
-                    "config")
-
-                if parsed_url.netloc not in ret:
-                    ret[parsed_url.netloc] = dict()
-
-                if service_name not in ret[parsed_url.netloc]:
-                    ret[parsed_url.netloc][service_name] = dict()
-                http_client = tornado.httpclient.AsyncHTTPClient()
-                try:
-                    res = yield http_client.fetch(config_url,
-                                                  validate_cert=False)
-                    log.debug("type of body: %s", type(res.body))
-                    log.debug("body: %s", res.body)
-                    data = json.loads(res.body).values()[0]
-                    log.debug("%s", data)
-                    ret[parsed_url.netloc][service_name] = {
-                        url: data
-                    }
-                except:
-                    ret[parsed_url.netloc][service_name] = {
-                        url: 'None'
-                    }
+    def post(self):
+        try:
+            body = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'body is not JSON')
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, 'body is not a JSON object')
+        register = self._services(body.get('register', []))
+        unregister = self._services(body.get('unregister', []))
+        txn = bool(body.get('txn', False))
+
+        registered, unregistered = yield [
+            self.sd.register_many(register, tags=body.get('tags'), txn=txn),
+            self.sd.unregister_many(unregister, txn=txn)
+        ]
+        self.finish(json.dumps({
+            'register': self._outcome(registered),
+            'unregister': self._outcome(unregistered)
+        }))
+
+
+class ServiceHandler(tornado.web.RequestHandler):
+    """Handles all discovery messages via REST API.
+
+    GET /services?tag=v2&tag=eu&node=node1 only lists the instances
+    having all the tags, on that node.
 
-        log.debug("About to return: %s", str(ret))
-        self.finish(json.dumps(ret))
+    With ?stream=1 or Accept: application/x-ndjson the configs are not
+    cached but streamed, one JSON line per instance as soon as it
+    answers:
 
+        {"service": ..., "url": ..., "config": ..., "ms": ...}
+    """
 
-class ConfigHandler(tornado.web.RequestHandler):
-    """Servers all config for this service"""
+    # of the cached response being sent, None when streaming
+    _etag = None
+
+    def initialize(self, sd, cache):
+        self.sd = sd
+        self.cache = cache
 
     @classmethod
-    def routes(cls):
+    def routes(cls, sd=None, fetcher=None, cache=None, events=None):
+        """routes sharing one ServiceDiscovery, ConfigFetcher,
+        ResponseCache and CatalogEvents across all requests"""
+        if sd is None:
+            sd = AsyncServiceDiscovery(
+                endpoint=config.get('ServiceDiscovery', 'sd'))
+        if fetcher is None:
+            fetcher = ConfigFetcher(sd)
+        if cache is None:
+            cache = ResponseCache(fetcher)
+        if events is None:
+            events = CatalogEvents(sd)
+        kwargs = dict(sd=sd, cache=cache)
+        watch = dict(
+            events=events,
+            heartbeat=config.getfloat('ServiceDiscovery', 'watch_heartbeat'),
+            max_watchers=config.getint('ServiceDiscovery', 'max_watchers'))
         return [
-            (r'/config/(.*)/(.*)', cls),
-            (r'/config/(.*)', cls),
-            (r'/config/', cls),
-            (r'/config', cls)
+            (r'/services/batch', BatchHandler, dict(sd=sd)),
+            (r'/services/watch', WatchHandler, watch),
+            (r'/services/(.*)', cls, kwargs),
+            (r'/services/', cls, kwargs),
+            (r'/services', cls, kwargs)
         ]
 
     def set_default_headers(self):
         # this is a JSON RESTful API
         self.set_header('Content-Type', 'application/json')
 
-    def get(self, section=None, key=None):
-        log.debug("called")
-        ret = dict()
-        if section is None and key is None:
-            for section in config.sections():
-                ret[section] = dict()
-                for key, value in config.items(section):
-                    ret[section][key] = value
-        elif section is not None and key is None:
-            ret[section] = dict()
-            for key, value in config.items(section):
-                ret[section][key] = value
-        elif section is not None and key is not None:
-            ret[section] = dict()
-            ret[section] = config.get(section, key)
-        else:
-            raise tornado.web.HTTPError(404)
-        log.debug("finished config")
-        self.finish(json.dumps(ret))
-
-
-# main routes registry
-servicesService = None
+    def compute_etag(self):
+        return self._etag
 
+    def _streaming(self):
+        if self.get_argument('stream', None) in ('1', 'true'):
+            return True
+        return NDJSON in self.request.headers.get('Accept', '')
 
-def on_shutdown(app):
-    """Shutdown callback"""
-    global servicesService
-    log.info("Shutdown started")
-    if servicesService is not None:
-        servicesService.unregister()
+    @tornado.gen.coroutine
+    def _stream(self, tags, node):
+        """writes a line per instance as its config comes, flushing each
+        one, so that nothing but the pending fetches stays in memory"""
+        fetcher = self.cache.fetcher
+        targets = yield fetcher.targets(tags, node)
+        self.set_header('Content-Type', NDJSON)
+        if not targets:
+            return
+        waiter = tornado.gen.WaitIterator(
+            *[fetcher.fetch(url) for _, url in targets])
+        while not waiter.done():
+            data, elapsed = yield waiter.next()
+            service_name, url = targets[waiter.current_index]
+            self.write(json.dumps({
+                'service': service_name,
+                'url': url,
+                'config': data,
+                'ms': round(elapsed * 1000, 1)
+            }) + '\n')
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                log.debug("client left, stopping the stream")
+                return
 
-    tornado.ioloop.IOLoop.instance().stop()
-    log.info("Shutdown completed")
+    @tornado.gen.coroutine
+    def get(self, id=None):
+        tags = self.get_arguments('tag')
+        node = self.get_argument('node', None)
+        if self._streaming():
+            yield self._stream(tags, node)
+            return
+        cache = self.cache.filtered(tags, node)
+        state = yield cache.get()
+        self.set_header('X-Cache', state)
+        self.set_header('Age', str(int(cache.age)))
+        if cache.timing:
+            self.set_header('Server-Timing', cache.timing)
+        # finish() answers 304 if the etag matches If-None-Match
+        self._etag = cache.etag
+        self.finish(cache.body)
+
+
+def configureHTTPClient():
+    """One pooled AsyncHTTPClient per process: curl keeps connections
+    alive across requests, so use it when pycurl is available"""
+    max_clients = config.getint('ServiceDiscovery', 'fetch_concurrency')
+    try:
+        import pycurl  # noqa
+        impl = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+    except ImportError:
+        log.warning("pycurl not available, no keep-alive to backends: "
+                    "install ServiceDiscovery[curl]")
+        impl = None
+    tornado.httpclient.AsyncHTTPClient.configure(impl,
+                                                 max_clients=max_clients)
 
 
 def startWebServer():
+    """binds the listening sockets, registers the service in consul and
+    serves it from `nproc` supervised worker processes"""
+    configureHTTPClient()
+    sd = AsyncServiceDiscovery(
+        endpoint=config.get('ServiceDiscovery', 'sd'),
+        snapshot=config.get('ServiceDiscovery', 'snapshot') or None,
+        max_staleness=config.getfloat('ServiceDiscovery', 'snapshot_max_age'))
+
     routes = []
-    routes.extend(ServiceHandler.routes())
+    events = CatalogEvents(sd)
+    routes.extend(ServiceHandler.routes(sd=sd, events=events))
     routes.extend(ConfigHandler.routes())
-    routes.extend(StatsHandler.routes())
+    sampler = StatsSampler()
+    routes.extend(StatsHandler.routes(sampler=sampler))
+    routes.extend(MetricsHandler.routes(sd=sd))
     settings = {
         "cookie_secret": config.get('ServiceDiscovery', 'secret'),
-        "xsrf_cookies": False
+        "xsrf_cookies": False,
+        "log_function": log_request
     }
 
-    application = tornado.web.Application(routes, **settings)
+    application = DrainingApplication(routes, **settings)
 
     protocol = config.get('ServiceDiscovery', 'protocol')
     addr = config.get('ServiceDiscovery', 'address')
     port = config.getint('ServiceDiscovery', 'port')
     service_name = config.get('ServiceDiscovery', 'servicename')
 
-    if protocol == "https":
-        server = tornado.httpserver.HTTPServer(application, ssl_options={
-            "certfile": config.get('ServiceDiscovery', 'servercert'),
-            "keyfile": config.get('ServiceDiscovery', 'serverkey')
-        })
-
-    else:
+    if protocol != "https":
         log.warning("Service Discovery Service should be on HTTPS!")
-        server = tornado.httpserver.HTTPServer(application)
 
     while True:
         try:
             log.info('try port %s', port)
-            server.bind(port, address=addr)
+            sockets = tornado.netutil.bind_sockets(port, address=addr)
             log.info("%s at %s://%s:%s", service_name, protocol, addr, port)
             break
         except Exception as e:
@@ -172,23 +465,69 @@ def startWebServer():
             port += 1
 
     config.set('ServiceDiscovery', 'port', str(port))
-    servicesService = Service(service_name, "%s://%s:%s" % (
-        protocol,
-        addr,
-        port
-    ))
-
-    server.start(config.getint('ServiceDiscovery', 'nproc'))
-    ioloop = tornado.ioloop.IOLoop.instance()
-    servicesService.register()
-
-    for sig in [SIGINT, SIGTERM, SIGQUIT]:
-        def l(sig, frame):
-            ioloop.add_callback_from_signal(on_shutdown)
-        signal(sig, l)
-
-    log.info("%s started and registered (PID: %s)", service_name, os.getpid())
-    ioloop.start()
+    service = Service(service_name, addr, port)
+    nproc = config.getint('ServiceDiscovery', 'nproc')
+    drain_timeout = config.getfloat('ServiceDiscovery', 'drain_timeout')
+    # built before forking so that all the workers map the same memory
+    shared = SharedCatalog() if nproc != 1 else None
+
+    def worker(task_id):
+        if protocol == "https":
+            server = tornado.httpserver.HTTPServer(application, ssl_options={
+                "certfile": config.get('ServiceDiscovery', 'servercert'),
+                "keyfile": config.get('ServiceDiscovery', 'serverkey')
+            })
+        else:
+            server = tornado.httpserver.HTTPServer(application)
+        server.add_sockets(sockets)
+
+        if shared is not None:
+            # one worker polls consul for all of them
+            if task_id == 0:
+                sd.publish(shared)
+            else:
+                sd.share(shared)
+        if sd.snapshot is not None and task_id == 0:
+            sd.persist()
+        ioloop = tornado.ioloop.IOLoop.current()
+        sampler.start()
+
+        @tornado.gen.coroutine
+        def shutdown():
+            log.info("Shutdown started")
+            # watch streams never end on their own
+            events.close()
+            yield drain(server, application, drain_timeout)
+            sampler.stop()
+            sd.close()
+            ioloop.stop()
+            log.info("Shutdown completed")
+
+        stopping = []
+
+        def on_signal(sig, frame):
+            if not stopping:
+                stopping.append(sig)
+                ioloop.add_callback_from_signal(shutdown)
+
+        for sig in [SIGINT, SIGTERM, SIGQUIT]:
+            signal(sig, on_signal)
+
+        log.info("%s worker %s started (PID: %s)", service_name, task_id,
+                 os.getpid())
+        ioloop.start()
+
+    # the workers don't touch this one: it only (de)registers
+    registry = ServiceDiscovery(endpoint=config.get('ServiceDiscovery', 'sd'))
+
+    def register():
+        # a failure aborts the startup: no workers, nothing to deregister
+        registry.register(service)
+        log.info("%s registered as %s", service_name, service.id)
+
+    Supervisor(worker, nproc=nproc, register=register,
+               deregister=lambda: registry.unregister(service),
+               drain_timeout=drain_timeout).run()
 
 
 def main():
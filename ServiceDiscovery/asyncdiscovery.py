@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import socket
+import logging
+
+import ujson as json
+
+import tornado.gen
+import tornado.locks
+import tornado.httpclient
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from ServiceDiscovery.discovery import (ServiceDiscovery, DEFAULT_DEADLINE,
+                                        IDEMPOTENT)
+from ServiceDiscovery.catalog import Entry, PASSING
+
+log = logging.getLogger(__name__)
+
+# errors of a connection that couldn't be made
+CONNECT_ERRNOS = frozenset([errno.ECONNREFUSED, errno.EHOSTUNREACH,
+                            errno.ENETUNREACH])
+# CURLE_COULDNT_RESOLVE_HOST, CURLE_COULDNT_CONNECT
+CURL_CONNECT_ERRNOS = frozenset([6, 7])
+
+
+def is_timeout(e):
+    """tells a timeout apart from other failed fetches"""
+    if not isinstance(e, tornado.httpclient.HTTPError) or e.code != 599:
+        return False
+    msg = str(e).lower()
+    return 'timeout' in msg or 'timed out' in msg
+
+
+def _unreachable(e):
+    """True if the request failed without an answer, timeouts apart"""
+    if isinstance(e, tornado.httpclient.HTTPError):
+        return e.code == 599 and not is_timeout(e)
+    return isinstance(e, (IOError, OSError))
+
+
+def _not_sent(e):
+    """True if the request failed connecting, before it was sent"""
+    if isinstance(e, tornado.httpclient.HTTPError):
+        if e.code != 599:
+            return False
+        # curl_httpclient.CurlError
+        if getattr(e, 'errno', None) in CURL_CONNECT_ERRNOS:
+            return True
+        # simple_httpclient: "Timeout while connecting"
+        return is_timeout(e) and 'connecting' in str(e).lower()
+    if isinstance(e, socket.gaierror):
+        return True
+    return isinstance(e, (IOError, OSError)) and e.errno in CONNECT_ERRNOS
+
+
+def _retriable(method, e):
+    """True if the request for `method` that failed with `e` can be sent
+    to another instance: it was never sent, or sending it twice is the
+    same as once"""
+    if method.upper() in IDEMPOTENT:
+        return _unreachable(e) or _not_sent(e)
+    return _not_sent(e)
+
+
+class AsyncServiceDiscovery(ServiceDiscovery):
+    """ServiceDiscovery for Tornado: lookups, registrations (batches
+    too) and calls are coroutines on a non-blocking AsyncHTTPClient, so
+    they never block the IOLoop. Caches, strategy and outlier detection
+    work as in ServiceDiscovery."""
+
+    def __init__(self, endpoint=None, http_client=None, **kwargs):
+        super(AsyncServiceDiscovery, self).__init__(endpoint=endpoint,
+                                                    **kwargs)
+        self._http_client = http_client
+        # health read in flight, shared by concurrent lookups
+        self._reading_health = None
+
+    @property
+    def http_client(self):
+        """the AsyncHTTPClient of the current IOLoop, unless given"""
+        if self._http_client is None:
+            self._http_client = tornado.httpclient.AsyncHTTPClient()
+        return self._http_client
+
+    @tornado.gen.coroutine
+    def _consul(self, url, method='GET', body=None):
+        """calls the consul HTTP API, returns the decoded body"""
+        if body is not None:
+            body = json.dumps(body)
+        self.consul.round_trips += 1
+        res = yield self.http_client.fetch(
+            url, method=method, body=body,
+            request_timeout=self.consul.timeout)
+        raise tornado.gen.Return(json.loads(res.body) if res.body else None)
+
+    @tornado.gen.coroutine
+    def listServices(self):
+        """names of all services in the catalog"""
+        names = self._cached_names()
+        if names is None:
+            catalog = yield self._consul(self.consul.url_services)
+            names = sorted(catalog.keys())
+            self.catalog.set('names', names)
+        raise tornado.gen.Return(names)
+
+    @tornado.gen.coroutine
+    def _health(self, status=PASSING):
+        """the Health lookups for `status` are filtered with, read in
+        bulk every `health_ttl` seconds; None if there is none"""
+        if not self._filters_health(status):
+            raise tornado.gen.Return(None)
+        pushed, health = self._pushed_health()
+        if pushed:
+            raise tornado.gen.Return(health)
+        previous = self.health.peek('state')
+        health = self.health.get('state')
+        if health is None:
+            if self._reading_health is None or self._reading_health.done():
+                self._reading_health = self._read_health(previous)
+            health = yield self._reading_health
+        raise tornado.gen.Return(health)
+
+    @tornado.gen.coroutine
+    def _read_health(self, previous):
+        try:
+            checks = yield self._consul(self.consul.url_health_state)
+        except Exception as e:
+            raise tornado.gen.Return(self._health_unavailable(previous, e))
+        raise tornado.gen.Return(self._store_health(checks))
+
+    @tornado.gen.coroutine
+    def getServices(self, key, tags=(), node=None, status=PASSING):
+        """get all services of type `key` having all of `tags`, and on
+        `node` if given, but the ejected ones, as a tuple of urls shared
+        with the cache: don't modify it.
+
+        Only the instances passing their consul checks are returned; with
+        `status` 'warning' the ones warning too, with 'critical' all"""
+        services = self._cached(key)
+        if services is None:
+            log.debug("Refreshing Service definition for %s", key)
+            try:
+                services = yield self._consul('{}/{}'.format(
+                    self.consul.url_service, key))
+            except Exception:
+                services = self._from_snapshot(key)
+                if services is None:
+                    raise
+                log.warning("consul unreachable, %s from the snapshot", key)
+            else:
+                services = Entry.from_consul(services, self.scheme)
+                self._store(key, services)
+        health = yield self._health(status)
+        raise tornado.gen.Return(
+            self._urls(services, tags, node, health, status))
+
+    @tornado.gen.coroutine
+    def getService(self, key, exclude=(), tags=(), node=None,
+                   status=PASSING):
+        """get a service of type `key`, not in `exclude`, picked by
+        `strategy` among the ones `getServices` returns"""
+        services = yield self.getServices(key, tags, node, status)
+        raise tornado.gen.Return(self._select(key, services, exclude))
+
+    @tornado.gen.coroutine
+    def register(self, service, datacenter=None, check=None, tags=None):
+        log.debug("About to register service: %s", service)
+        yield self._consul(
+            self.consul.url_register, method='PUT',
+            body=self.consul.payload(
+                **self._registration(service, check, tags)))
+
+    @tornado.gen.coroutine
+    def unregister(self, service):
+        log.debug("About to unregister service: %s", service)
+        yield self._consul(
+            '{}/{}'.format(self.consul.url_deregister, service.id),
+            method='PUT', body={})
+
+    @tornado.gen.coroutine
+    def _batch(self, func, services, verb, txn, tags=None):
+        services = list(services)
+        if txn:
+            results = []
+            for chunk, ops in self._txn_chunks(verb, services, tags):
+                error = None
+                try:
+                    yield self._consul(self.consul.url_txn, method='PUT',
+                                       body=ops)
+                except Exception as e:
+                    log.warning("transaction of %s services failed: %s",
+                                len(chunk), e)
+                    error = e
+                results.extend((x, error) for x in chunk)
+        else:
+            semaphore = tornado.locks.Semaphore(self.workers)
+
+            @tornado.gen.coroutine
+            def run(service):
+                error = None
+                with (yield semaphore.acquire()):
+                    try:
+                        yield func(service)
+                    except Exception as e:
+                        log.warning("%s of %s failed: %s", verb, service, e)
+                        error = e
+                raise tornado.gen.Return((service, error))
+
+            results = yield [run(x) for x in services]
+        self._forget(services)
+        raise tornado.gen.Return(results)
+
+    @tornado.gen.coroutine
+    def _healthy(self, base_url, timeout):
+        try:
+            res = yield self.http_client.fetch(
+                base_url + "/health", request_timeout=timeout,
+                validate_cert=False, raise_error=False)
+        except Exception as e:
+            log.debug("health of %s failed: %s", base_url, e)
+            raise tornado.gen.Return(False)
+        raise tornado.gen.Return(res.code == 200)
+
+    @tornado.gen.coroutine
+    def call(self, key, path, method='GET', ck_health=False,
+             deadline=DEFAULT_DEADLINE, **kwargs):
+        """sends a `method` request for `path` to an instance of `key`
+        and returns its decoded JSON body, retrying on another instance
+        as ServiceDiscovery.call does. Other `kwargs` go to
+        `AsyncHTTPClient.fetch`."""
+        start = monotonic()
+        timeout = kwargs.pop('request_timeout', None)
+        kwargs.setdefault('validate_cert', False)
+        tried = set()
+        # why the last instance couldn't be reached
+        error = None
+        while True:
+            remaining = deadline - (monotonic() - start)
+            if remaining <= 0:
+                raise tornado.gen.TimeoutError(
+                    'deadline of {}s exceeded calling {}{}'.format(
+                        deadline, key, path))
+            try:
+                base_url = yield self.getService(key, exclude=tried)
+            except Exception:
+                if error is None:
+                    raise
+                # every instance was tried: that's the real failure
+                raise error
+            tried.add(base_url)
+            request_timeout = remaining if timeout is None else \
+                min(timeout, remaining)
+
+            if ck_health:
+                healthy = yield self._healthy(base_url, request_timeout)
+                if not healthy:
+                    log.warning("%s is not healthy, trying another",
+                                base_url)
+                    continue
+
+            sent = monotonic()
+            try:
+                res = yield self.http_client.fetch(
+                    base_url + path, method=method,
+                    request_timeout=request_timeout, raise_error=False,
+                    **kwargs)
+            except Exception as e:
+                self.outliers.record_failure(base_url)
+                if not _retriable(method, e):
+                    raise
+                error = e
+                log.warning("%s failed on %s (%s), trying another",
+                            path, base_url, e)
+                continue
+            if res.code == 599:
+                # older Tornado reports network errors as responses
+                self.outliers.record_failure(base_url)
+                if _retriable(method, res.error):
+                    error = res.error
+                    continue
+                res.rethrow()
+            if res.code >= 500:
+                self.outliers.record_failure(base_url)
+            else:
+                self.outliers.record_success(base_url, monotonic() - sent)
+            raise tornado.gen.Return(json.loads(res.body) if res.body
+                                     else None)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+import random
+import logging
+import threading
+import itertools
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 5.0
+DEFAULT_TIMEOUT = 1.0
+
+
+class Strategy(object):
+    """Picks the instance to use among the ones of a service"""
+
+    def select(self, key, urls):
+        """returns one of `urls`, the instances of service `key`"""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RandomStrategy(Strategy):
+    def select(self, key, urls):
+        return random.choice(urls)
+
+
+class RoundRobinStrategy(Strategy):
+    def __init__(self):
+        self._counters = {}
+
+    def select(self, key, urls):
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters.setdefault(key, itertools.count())
+        return urls[next(counter) % len(urls)]
+
+
+class LoadSampler(object):
+    """Samples `/stats/index` of the instances it is asked about, every
+    `interval` seconds in a background thread.
+
+    Instances nobody asked about for a few intervals are dropped."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL, timeout=DEFAULT_TIMEOUT,
+                 session=None):
+        self.interval = interval
+        self.timeout = timeout
+        if session is None:
+            import requests
+            session = requests.Session()
+        self.session = session
+        self.loads = {}
+        self._asked = {}
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def load(self, url):
+        """last sampled load of `url`, 0 when still unknown"""
+        self._asked[url] = monotonic()
+        if self._thread is None:
+            self.start()
+        return self.loads.get(url, 0.0)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            name="load-sampler")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def sample(self, url):
+        try:
+            res = self.session.get(url + "/stats/index",
+                                   timeout=self.timeout, verify=False)
+            res.raise_for_status()
+            self.loads[url] = float(res.json())
+        except Exception as e:
+            log.debug("sampling %s failed: %s", url, e)
+
+    def sample_all(self):
+        expired = monotonic() - 3 * self.interval
+        for url, asked in list(self._asked.items()):
+            if asked < expired:
+                self._asked.pop(url, None)
+                self.loads.pop(url, None)
+            else:
+                self.sample(url)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.sample_all()
+            self._stopped.wait(self.interval)
+
+
+class PowerOfTwoStrategy(Strategy):
+    """Picks two instances at random and uses the least loaded one,
+    according to the `/stats/index` they publish"""
+
+    def __init__(self, sampler=None):
+        self.sampler = sampler or LoadSampler()
+
+    def select(self, key, urls):
+        if len(urls) == 1:
+            return urls[0]
+        a, b = random.sample(urls, 2)
+        if self.sampler.load(b) < self.sampler.load(a):
+            return b
+        return a
+
+    def close(self):
+        self.sampler.stop()
+
+
+STRATEGIES = {
+    'random': RandomStrategy,
+    'roundrobin': RoundRobinStrategy,
+    'p2c': PowerOfTwoStrategy
+}
+
+
+def make_strategy(strategy):
+    """a Strategy from its name in STRATEGIES or a Strategy instance"""
+    if isinstance(strategy, Strategy):
+        return strategy
+    try:
+        return STRATEGIES[strategy]()
+    except KeyError:
+        raise ValueError('Unknown strategy "%s", use one of %s' % (
+            strategy, ', '.join(sorted(STRATEGIES))))
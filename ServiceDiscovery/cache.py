@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TTL = 30.0
+DEFAULT_MAXSIZE = 1024
+
+
+class TTLCache(object):
+    """Bounded mapping where every entry expires on its own TTL.
+
+    Entries are kept in LRU order: a successful `get` moves the entry
+    to the end, and inserting past `maxsize` evicts from the front.
+    Expired entries are dropped lazily on access."""
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL,
+                 timer=monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        """returns the value for `key` or `default` if missing or expired"""
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires is not None and expires <= self.timer():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        """returns the value for `key` ignoring its expiry, without
+        touching LRU order or counters"""
+        with self._lock:
+            try:
+                return self._data[key][0]
+            except KeyError:
+                return default
+
+    def set(self, key, value, ttl=None):
+        """stores `value` under `key`; `ttl` overrides the default,
+        use `float('inf')` to never expire"""
+        if ttl is None:
+            ttl = self.ttl
+        expires = None if ttl == float('inf') else self.timer() + ttl
+        with self._lock:
+            if key in self._data:
+                del self._data[key]
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                evicted, _ = self._data.popitem(last=False)
+                self.evictions += 1
+                log.debug("evicted %s", evicted)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def keys(self):
+        """keys of non expired entries, oldest first"""
+        now = self.timer()
+        with self._lock:
+            return [
+                k for k, (_, expires) in self._data.items()
+                if expires is None or expires > now
+            ]
+
+    def items(self):
+        """(key, value) of non expired entries, oldest first"""
+        now = self.timer()
+        with self._lock:
+            return [
+                (k, v) for k, (v, expires) in self._data.items()
+                if expires is None or expires > now
+            ]
+
+    def info(self):
+        """counters of this cache as a dict"""
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def _move_to_end(self, key):
+        self._data[key] = self._data.pop(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            try:
+                _, expires = self._data[key]
+            except KeyError:
+                return False
+            return expires is None or expires > self.timer()
+
+    def __getitem__(self, key):
+        marker = object()
+        value = self.get(key, marker)
+        if value is marker:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def __len__(self):
+        return len(self._data)
+
+    def __iter__(self):
+        return iter(self.keys())
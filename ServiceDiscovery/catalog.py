@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""Compact, read-only records of what the consul catalog holds"""
+
+try:
+    from sys import intern
+except ImportError:
+    pass
+
+# filtered lookups remembered per Entry
+MAX_QUERIES = 64
+
+PASSING = 'passing'
+WARNING = 'warning'
+CRITICAL = 'critical'
+# how bad a check status is; unknown ones count as critical
+SEVERITY = {PASSING: 0, WARNING: 1, CRITICAL: 2}
+
+
+class Instance(object):
+    """One instance of a service"""
+
+    __slots__ = ('id', 'name', 'addr', 'port', 'node', 'tags', 'url')
+
+    def __init__(self, id, name, addr, port, node, tags, url):
+        self.id = id
+        self.name = name
+        self.addr = addr
+        self.port = port
+        self.node = node
+        self.tags = tags
+        self.url = url
+
+    @classmethod
+    def from_consul(cls, x, scheme):
+        """builds an Instance from an entry of /v1/catalog/service"""
+        addr = x['ServiceAddress'] or x['Address']
+        port = x['ServicePort']
+        return cls(
+            x['ServiceID'],
+            intern(str(x['ServiceName'])),
+            intern(str(addr)),
+            port,
+            intern(str(x['Node'])),
+            tuple(intern(str(t)) for t in x.get('ServiceTags') or ()),
+            "{}://{}:{}".format(scheme, addr, port))
+
+    def __repr__(self):
+        return "<Instance id:%s, url:%s>" % (self.id, self.url)
+
+
+class Entry(object):
+    """Cached instances of a service, with their urls computed once.
+
+    Lookups by tag and node go through an inverted index, built the
+    first time they are needed; their results are kept, up to
+    MAX_QUERIES of them. A catalog change builds a new Entry, so only
+    the services that changed are indexed again."""
+
+    __slots__ = ('instances', 'urls', '_tags', '_nodes', '_queries')
+
+    def __init__(self, instances):
+        self.instances = tuple(instances)
+        self.urls = tuple(x.url for x in self.instances)
+        self._tags = None
+        self._nodes = None
+        self._queries = None
+
+    @classmethod
+    def from_consul(cls, services, scheme):
+        return cls(Instance.from_consul(x, scheme) for x in services)
+
+    def _index(self):
+        """positions of the instances by tag and by node"""
+        tags = {}
+        nodes = {}
+        for i, x in enumerate(self.instances):
+            for tag in x.tags:
+                tags.setdefault(tag, []).append(i)
+            nodes.setdefault(x.node, []).append(i)
+        self._tags = tags
+        self._nodes = nodes
+        self._queries = {}
+
+    def select(self, tags=(), node=None):
+        """urls of the instances having all of `tags`, and on `node` if
+        given"""
+        if not tags and node is None:
+            return self.urls
+        if self._queries is None:
+            self._index()
+        key = (frozenset(tags), node)
+        urls = self._queries.get(key)
+        if urls is not None:
+            return urls
+
+        postings = [self._tags.get(tag, ()) for tag in key[0]]
+        if node is not None:
+            postings.append(self._nodes.get(node, ()))
+        postings.sort(key=len)
+        found = set(postings[0])
+        for positions in postings[1:]:
+            if not found:
+                break
+            found.intersection_update(positions)
+        urls = tuple(self.urls[i] for i in sorted(found))
+        if len(self._queries) < MAX_QUERIES:
+            self._queries[key] = urls
+        return urls
+
+    def __len__(self):
+        return len(self.instances)
+
+    def __iter__(self):
+        return iter(self.instances)
+
+
+EMPTY = Entry(())
+
+
+class Health(object):
+    """Worst check status of every instance, from a bulk read of
+    /v1/health/state/any.
+
+    Only the checks not passing are kept, so an instance with none of
+    them passes. A check with no ServiceID is a node check, it applies
+    to every instance on that node."""
+
+    __slots__ = ('nodes', 'services')
+
+    def __init__(self, nodes, services):
+        # node -> severity
+        self.nodes = nodes
+        # service name -> {(node, instance id): severity}
+        self.services = services
+
+    @classmethod
+    def from_consul(cls, checks):
+        nodes = {}
+        services = {}
+        for check in checks:
+            severity = SEVERITY.get(check['Status'], SEVERITY[CRITICAL])
+            if not severity:
+                continue
+            if check.get('ServiceID'):
+                instances = services.setdefault(check['ServiceName'], {})
+                key = (check['Node'], check['ServiceID'])
+            else:
+                instances = nodes
+                key = check['Node']
+            instances[key] = max(instances.get(key, 0), severity)
+        return cls(nodes, services)
+
+    def severity(self, x):
+        """severity of the worst check of the Instance `x`"""
+        return max(self.nodes.get(x.node, 0),
+                   self.services.get(x.name, {}).get((x.node, x.id), 0))
+
+    def filter(self, entry, urls, status=PASSING):
+        """`urls`, some of the Entry `entry`, without the instances
+        whose status is worse than `status`; `urls` itself when none
+        is"""
+        limit = SEVERITY[status]
+        if not entry or limit >= SEVERITY[CRITICAL] or \
+           (not self.nodes and entry.instances[0].name not in self.services):
+            return urls
+        worse = set(x.url for x in entry if self.severity(x) > limit)
+        if not worse:
+            return urls
+        return tuple(url for url in urls if url not in worse)
+
+
+# no check known: filters nothing out
+NO_HEALTH = Health({}, {})
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import logging
+
+import requests
+import consul
+
+log = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_POOL_SIZE = 64
+# most operations consul accepts in a single transaction
+TXN_MAX_OPS = 64
+
+
+class TxnError(Exception):
+    pass
+
+
+class ConsulClient(consul.Client):
+    """`consul.Client` on a pooled `requests.Session`, with timeouts and
+    support for Consul blocking queries (`index`/`wait` long-poll)"""
+
+    def __init__(self, endpoint='http://localhost:8500',
+                 timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE):
+        super(ConsulClient, self).__init__(endpoint=endpoint)
+        endpoint = endpoint.rstrip('/')
+        # consul.Client builds these with a double slash, which makes
+        # consul answer every lookup with a redirect
+        self.url_services = '{}/v1/catalog/services'.format(endpoint)
+        self.url_service = '{}/v1/catalog/service'.format(endpoint)
+        self.url_nodes = '{}/v1/catalog/nodes'.format(endpoint)
+        self.url_node = '{}/v1/catalog/node'.format(endpoint)
+        self.url_txn = '{}/v1/txn'.format(endpoint)
+        self.url_health_state = '{}/v1/health/state/any'.format(endpoint)
+        self.timeout = timeout
+        self.round_trips = 0
+        self.session = requests.Session()
+        # room for the refresh workers and the watcher long-polls
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _get(self, url, index=None, wait=None, timeout=None):
+        """GETs `url`, returns a tuple (X-Consul-Index, json body).
+
+        With `index` the request blocks on consul side until the
+        resource changes past `index` or `wait` seconds pass."""
+        params = {}
+        if timeout is None:
+            timeout = self.timeout
+        if index is not None:
+            params['index'] = index
+            if wait is not None:
+                params['wait'] = '{}s'.format(int(wait))
+                # consul adds up to wait/16 of jitter to the hold time
+                timeout += wait + wait / 16.0
+        self.round_trips += 1
+        r = self.session.get(url, params=params, timeout=timeout)
+        r.raise_for_status()
+        new_index = r.headers.get('X-Consul-Index')
+        if new_index is not None:
+            new_index = int(new_index)
+        return new_index, r.json()
+
+    @staticmethod
+    def payload(id, name, address, port=None, tags=None, check=None):
+        """body of an agent service registration"""
+        service = {'ID': id, 'Name': name, 'Address': address}
+        if port:
+            service['Port'] = int(port)
+        if tags:
+            service['Tags'] = tags
+        if check:
+            service['Check'] = check
+        return service
+
+    def register(self, id, name, address, port=None, tags=None, check=None):
+        """Register a new service with the local consul agent"""
+        self.round_trips += 1
+        r = self.session.put(self.url_register, timeout=self.timeout,
+                             json=self.payload(id, name, address, port,
+                                               tags, check))
+        if r.status_code != 200:
+            raise consul.consulRegistrationError(
+                'PUT returned {}'.format(r.status_code))
+        return r
+
+    def deregister(self, id):
+        """Deregister a service with the local consul agent"""
+        self.round_trips += 1
+        r = self.session.put('{}/{}'.format(self.url_deregister, id),
+                             timeout=self.timeout)
+        if r.status_code != 200:
+            raise consul.consulDeregistrationError(
+                'PUT returned {}'.format(r.status_code))
+        return r
+
+    def txn(self, ops):
+        """applies `ops` atomically with the transaction API, at most
+        TXN_MAX_OPS of them"""
+        self.round_trips += 1
+        r = self.session.put(self.url_txn, json=ops, timeout=self.timeout)
+        if r.status_code != 200:
+            raise TxnError('PUT returned {}: {}'.format(r.status_code,
+                                                        r.text))
+        return r.json().get('Results')
+
+    def list(self):
+        """List all services that have been registered"""
+        return self._get(self.url_services)[1]
+
+    def info(self, name, timeout=None):
+        """Info about a given service"""
+        return self._get('{}/{}'.format(self.url_service, name),
+                         timeout=timeout)[1]
+
+    def health_state(self):
+        """every health check of the catalog, in one request"""
+        return self._get(self.url_health_state)[1]
+
+    def watch_list(self, index=None, wait=None):
+        """blocking version of `list`, returns (index, services)"""
+        return self._get(self.url_services, index=index, wait=wait)
+
+    def watch_info(self, name, index=None, wait=None):
+        """blocking version of `info`, returns (index, instances)"""
+        return self._get('{}/{}'.format(self.url_service, name),
+                         index=index, wait=wait)
+
+    def watch_health_state(self, index=None, wait=None):
+        """blocking version of `health_state`, returns (index, checks)"""
+        return self._get(self.url_health_state, index=index, wait=wait)
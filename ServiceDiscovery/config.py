@@ -3,57 +3,134 @@
 import os
 import logging
 
-from socket import gethostname
-from multiprocessing import cpu_count
-from tornado.options import define, options, parse_command_line
-from tornado.log import enable_pretty_logging
-
 try:
     from configparser import ConfigParser
 except ImportError:
     from ConfigParser import ConfigParser
 
 
-enable_pretty_logging()
 log = logging.getLogger(__name__)
 
 DEFAULT_SERVER_CERT = "server.crt"
 DEFAULT_SERVER_KEY = "server.key"
 DEFAULT_PORT = 70070
 DEFAULT_CONSUL = "http://localhost:8500"
+DEFAULT_FETCH_CONCURRENCY = 16
+DEFAULT_FETCH_TIMEOUT = 5.0
+DEFAULT_SERVICES_TTL = 10.0
+DEFAULT_SNAPSHOT_MAX_AGE = 24 * 3600.0
+DEFAULT_DRAIN_TIMEOUT = 10.0
+DEFAULT_WATCH_HEARTBEAT = 15.0
+DEFAULT_MAX_WATCHERS = 1000
+
+
+def defineOptions():
+    """defines the command line options of ServiceDiscovery, on first
+    use so that importing a module doesn't touch tornado.options"""
+    from tornado.options import define, options
 
-if 'serverkey' not in options:
-    define('serverkey', default=DEFAULT_SERVER_KEY,
-           help='SSL key')
+    if 'serverkey' not in options:
+        define('serverkey', default=DEFAULT_SERVER_KEY,
+               help='SSL key')
 
-if 'servercert' not in options:
-    define('servercert', default=DEFAULT_SERVER_CERT,
-           help='SSL cert')
+    if 'servercert' not in options:
+        define('servercert', default=DEFAULT_SERVER_CERT,
+               help='SSL cert')
 
-if 'port' not in options:
-    define('port', default=DEFAULT_PORT, type=int, help="listen port")
+    if 'port' not in options:
+        define('port', default=DEFAULT_PORT, type=int, help="listen port")
 
-if 'nproc' not in options:
-    define('nproc', default=1, type=int,
-           help="Number of cores")
+    if 'nproc' not in options:
+        define('nproc', default=1, type=int,
+               help="Number of cores")
 
-if 'debug' not in options:
-    define('debug', default=False, type=bool)
+    if 'debug' not in options:
+        define('debug', default=False, type=bool)
 
-if 'sd' not in options:
-    define('sd', default=os.environ.get('SD', DEFAULT_CONSUL), type=str)
+    if 'sd' not in options:
+        define('sd', default=os.environ.get('SD', DEFAULT_CONSUL), type=str)
+
+    if 'registryHost' not in options:
+        define("registryHost", default="localhost",
+               help="Redis host")
+
+    if 'registryPort' not in options:
+        define("registryPort", default=6379, type=int, help="Redis port")
+
+    if 'fetch_concurrency' not in options:
+        define('fetch_concurrency', default=DEFAULT_FETCH_CONCURRENCY,
+               type=int, help="max concurrent /config fetches for /services")
+
+    if 'fetch_timeout' not in options:
+        define('fetch_timeout', default=DEFAULT_FETCH_TIMEOUT, type=float,
+               help="timeout in seconds of each /config fetch for "
+                    "/services")
+
+    if 'services_ttl' not in options:
+        define('services_ttl', default=DEFAULT_SERVICES_TTL, type=float,
+               help="seconds the /services response is served from "
+                    "cache")
+
+    if 'snapshot' not in options:
+        define('snapshot', default='', type=str,
+               help="file the catalog is persisted to, none if empty")
+
+    if 'snapshot_max_age' not in options:
+        define('snapshot_max_age', default=DEFAULT_SNAPSHOT_MAX_AGE,
+               type=float,
+               help="seconds after which the catalog snapshot isn't used")
+
+    if 'drain_timeout' not in options:
+        define('drain_timeout', default=DEFAULT_DRAIN_TIMEOUT, type=float,
+               help="seconds workers have to finish their requests on "
+                    "shutdown")
+
+    if 'watch_heartbeat' not in options:
+        define('watch_heartbeat', default=DEFAULT_WATCH_HEARTBEAT,
+               type=float,
+               help="seconds of silence before /services/watch sends a "
+                    "heartbeat")
+
+    if 'max_watchers' not in options:
+        define('max_watchers', default=DEFAULT_MAX_WATCHERS, type=int,
+               help="max concurrent /services/watch streams per process")
+    return options
+
+
+class VersionedConfig(ConfigParser):
+    """ConfigParser counting its changes in `version`, so that what is
+    derived from it can be computed once per change"""
+
+    version = 0
+
+    def _read(self, *args, **kwargs):
+        ConfigParser._read(self, *args, **kwargs)
+        self.version += 1
+
+    def add_section(self, section):
+        ConfigParser.add_section(self, section)
+        self.version += 1
+
+    def set(self, section, option, value=None):
+        ConfigParser.set(self, section, option, value)
+        self.version += 1
+
+    def remove_option(self, section, option):
+        removed = ConfigParser.remove_option(self, section, option)
+        self.version += 1
+        return removed
+
+    def remove_section(self, section):
+        removed = ConfigParser.remove_section(self, section)
+        self.version += 1
+        return removed
 
-if 'registryHost' not in options:
-    define("registryHost", default="localhost",
-           help="Redis host")
-    
-if 'registryPort' not in options:
-    define("registryPort", default=6379, type=int, help="Redis port")
-                    
 
 def makeDefaultConfig():
     """builds the default config for ServiceDiscovery"""
-    config = ConfigParser()
+    from socket import gethostname
+    options = defineOptions()
+    config = VersionedConfig()
     config.add_section('ServiceDiscovery')
     config.set('ServiceDiscovery', 'nproc', str(options.nproc))
     config.set('ServiceDiscovery', 'secret',
@@ -70,6 +147,20 @@ def makeDefaultConfig():
     
     config.set('ServiceDiscovery', 'registryHost', options.registryHost)
     config.set('ServiceDiscovery', 'registryPort', str(options.registryPort))
+
+    config.set('ServiceDiscovery', 'fetch_concurrency',
+               str(options.fetch_concurrency))
+    config.set('ServiceDiscovery', 'fetch_timeout', str(options.fetch_timeout))
+    config.set('ServiceDiscovery', 'services_ttl', str(options.services_ttl))
+    config.set('ServiceDiscovery', 'snapshot', options.snapshot)
+    config.set('ServiceDiscovery', 'snapshot_max_age',
+               str(options.snapshot_max_age))
+    config.set('ServiceDiscovery', 'drain_timeout',
+               str(options.drain_timeout))
+    config.set('ServiceDiscovery', 'watch_heartbeat',
+               str(options.watch_heartbeat))
+    config.set('ServiceDiscovery', 'max_watchers',
+               str(options.max_watchers))
     
     log.info("Rebuilt config")
     for section in config.sections():
@@ -84,8 +175,14 @@ _config = None
 
 
 def config():
+    """the config of ServiceDiscovery, built on first call from the
+    command line options; this also sets up logging"""
     global _config
     if _config is None:
+        from tornado.options import parse_command_line
+        from tornado.log import enable_pretty_logging
+        enable_pretty_logging()
+        defineOptions()
         try:
             parse_command_line(final=False)
         except Exception as e:
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import hashlib
 import ujson as json
 
 import tornado.web
+from tornado.log import access_log
 
 from ServiceDiscovery.config import config as _config
+from ServiceDiscovery.metrics import (REGISTRY, REQUESTS, LATENCY,
+                                      CONTENT_TYPE, discovery_metrics)
 
 config = _config()
 
@@ -25,7 +29,14 @@ class HealthHandler(tornado.web.RequestHandler):
 
 
 class ConfigHandler(tornado.web.RequestHandler):
-    """Servers all config for this service"""
+    """Servers all config for this service.
+
+    Responses are serialized once per version of the config and sent
+    with a strong ETag, so pollers sending If-None-Match get a 304"""
+
+    # (section, key) -> (body, etag), for `_version` of the config
+    _responses = {}
+    _version = None
 
     @classmethod
     def routes(cls):
@@ -36,12 +47,22 @@ class ConfigHandler(tornado.web.RequestHandler):
             (r'/config', cls)
         ]
 
-    def set_default_headers(self):
-        # this is a JSON RESTful API
-        self.set_header('Content-Type', 'application/json')
+    @classmethod
+    def response(cls, section=None, key=None):
+        """(body, etag) of the config, of its `section` or of the `key`
+        of that section"""
+        if cls._version != config.version:
+            cls._responses = {}
+            cls._version = config.version
+        response = cls._responses.get((section, key))
+        if response is None:
+            body = json.dumps(cls._serialize(section, key)).encode('utf-8')
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            response = cls._responses[(section, key)] = (body, etag)
+        return response
 
-    def get(self, section=None, key=None):
-        log.debug("called")
+    @staticmethod
+    def _serialize(section, key):
         ret = dict()
         if section is None and key is None:
             for section in config.sections():
@@ -57,6 +78,57 @@ class ConfigHandler(tornado.web.RequestHandler):
             ret[section] = config.get(section, key)
         else:
             raise tornado.web.HTTPError(404)
-        log.debug("finished config")
-        self.finish(json.dumps(ret))
-        self.set_header('Content-type', 'text/plain; charset=utf-8')
+        return ret
+
+    def set_default_headers(self):
+        # this is a JSON RESTful API
+        self.set_header('Content-Type', 'application/json')
+
+    def compute_etag(self):
+        return self._etag
+
+    def get(self, section=None, key=None):
+        # finish() answers 304 if the etag matches If-None-Match
+        body, self._etag = self.response(section, key)
+        self.finish(body)
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Serves `registry` in the Prometheus text format"""
+
+    def initialize(self, registry):
+        self.registry = registry
+
+    @classmethod
+    def routes(cls, registry=REGISTRY, sd=None):
+        """route exposing `registry`, plus the internals of `sd` if
+        given"""
+        if sd is not None:
+            for metric in discovery_metrics(sd):
+                registry.register(metric)
+        return [
+            (r'/metrics', cls, dict(registry=registry))
+        ]
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.finish(self.registry.expose())
+
+
+def log_request(handler):
+    """`log_function` of the Application: records the request in
+    REQUESTS and LATENCY, then writes the usual access log line"""
+    status = handler.get_status()
+    request_time = handler.request.request_time()
+    name = type(handler).__name__
+    REQUESTS.inc((name, handler.request.method, status))
+    LATENCY.observe(request_time, (name, handler.request.method))
+
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", status, handler._request_summary(),
+               1000.0 * request_time)
@@ -1,35 +1,308 @@
 import json
-import requests
-import random
 import logging
+import threading
 
-import consul
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
 
 from ServiceDiscovery.config import config as _config
+from ServiceDiscovery.cache import TTLCache, DEFAULT_TTL, DEFAULT_MAXSIZE
+from ServiceDiscovery.catalog import (Entry, EMPTY, Health, NO_HEALTH,
+                                      PASSING, SEVERITY, CRITICAL)
+from ServiceDiscovery.balancer import make_strategy
+from ServiceDiscovery.outlier import OutlierDetector
+from ServiceDiscovery.metrics import Histogram
+from ServiceDiscovery.watch import (CatalogWatcher, DEFAULT_WAIT,
+                                    DEFAULT_MAX_WATCHES)
+from ServiceDiscovery.shared import Publisher, SnapshotFile
 
-config = _config()
+DEFAULT_NEGATIVE_TTL = 5.0
+DEFAULT_WORKERS = 8
+DEFAULT_FETCH_TIMEOUT = 5.0
+DEFAULT_POOL_SIZE = 10
+DEFAULT_DEADLINE = 30.0
+DEFAULT_MAX_STALENESS = 24 * 3600.0
+DEFAULT_PERSIST_INTERVAL = 30.0
+DEFAULT_HEALTH_TTL = 5.0
+# methods `call` retries whatever the failure: sending them twice is
+# the same as sending them once
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT',
+                        'DELETE'])
 
 log = logging.getLogger(__name__)
 
 
+def _not_sent(e):
+    """True if the requests exception `e` was raised connecting, before
+    the request was sent"""
+    import requests
+    from requests.packages.urllib3.exceptions import ConnectTimeoutError
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    # a MaxRetryError whose reason is a NewConnectionError, a subclass
+    # of ConnectTimeoutError: refused, unreachable or unresolved
+    reason = getattr(e.args[0] if e.args else None, 'reason', None)
+    return isinstance(reason, ConnectTimeoutError)
+
+
 class ServiceDiscovery(object):
-    """Main entry point for ServiceDiscovery"""
+    """Main entry point for ServiceDiscovery.
 
-    def __init__(self, endpoint=None):
+    Importing this module is cheap: the consul client, `requests` and
+    the thread pool are loaded when first needed, and the config only
+    when no `endpoint` is given"""
+
+    def __init__(self, endpoint=None, ttl=DEFAULT_TTL,
+                 maxsize=DEFAULT_MAXSIZE, watch=False,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, workers=DEFAULT_WORKERS,
+                 fetch_timeout=DEFAULT_FETCH_TIMEOUT,
+                 pool_size=DEFAULT_POOL_SIZE, strategy='random',
+                 outliers=None, scheme='https', snapshot=None,
+                 max_staleness=DEFAULT_MAX_STALENESS,
+                 health_ttl=DEFAULT_HEALTH_TTL,
+                 max_watches=DEFAULT_MAX_WATCHES):
+        from ServiceDiscovery.client import ConsulClient
         if endpoint is None:
-            endpoint = config.get('ServiceDiscovery', 'sd')
-        self.consul = consul.Client(endpoint=endpoint)
-        self.services = {}
+            endpoint = _config().get('ServiceDiscovery', 'sd')
+        # a connection for every refresh worker and watch, and for the
+        # catalog and health watches
+        self.consul = ConsulClient(endpoint=endpoint,
+                                   pool_size=workers + max_watches + 2)
+        # scheme of the urls of the discovered services
+        self.scheme = scheme
+        self.services = TTLCache(maxsize=maxsize, ttl=ttl)
+        # keys consul doesn't know about, kept for a short while
+        self.missing = TTLCache(maxsize=maxsize, ttl=negative_ttl)
+        self.catalog = TTLCache(maxsize=1, ttl=ttl)
+        # consul health checks of the whole catalog, read at once
+        self.health = TTLCache(maxsize=1, ttl=health_ttl)
+        # one health read at a time, the others wait for it
+        self._health_lock = threading.Lock()
+        self.workers = workers
+        self.refresh_seconds = Histogram(
+            'servicediscovery_refresh_seconds',
+            'Duration of full catalog refreshes')
+        self.fetch_timeout = fetch_timeout
+        self._executor = None
+        self.pool_size = pool_size
+        self._session = None
+        # how getService picks an instance, see ServiceDiscovery.balancer
+        self.strategy = make_strategy(strategy)
+        # passive health of instances, from the outcome of `call`
+        self.outliers = outliers or OutlierDetector()
+        self.watcher = None
+        # services the watcher long-polls at most
+        self.max_watches = max_watches
+        # bumped on every change of `services` or `health`
+        self.generation = 0
+        # snapshot read instead of `services`, see `share`
+        self.shared = None
+        self.publisher = None
+        # catalog on disk, used until the first refresh and when consul
+        # can't be reached, if younger than `max_staleness` seconds
+        self.snapshot = SnapshotFile(snapshot) if snapshot else None
+        self.max_staleness = max_staleness
+        self.persister = None
+        self._warm = False
+        self._catching_up = None
+        if watch:
+            self.watch()
+
+    def watch(self, wait=DEFAULT_WAIT):
+        """keeps `services` up to date in background with consul
+        blocking queries, so lookups don't hit consul anymore"""
+        if self.watcher is None:
+            self.watcher = CatalogWatcher(self, wait=wait,
+                                          max_watches=self.max_watches)
+            self.watcher.start()
+        return self.watcher
+
+    def publish(self, shared):
+        """watches consul and publishes the catalog into the
+        SharedCatalog `shared`, for the processes reading it"""
+        self.watch()
+        if self.publisher is None:
+            self.publisher = Publisher(self, shared).start()
+        return self.publisher
+
+    def persist(self, interval=DEFAULT_PERSIST_INTERVAL):
+        """writes the catalog to the `snapshot` file every `interval`
+        seconds when it changed"""
+        if self.persister is None:
+            self.persister = Publisher(self, self.snapshot,
+                                       interval=interval).start()
+        return self.persister
+
+    def share(self, shared):
+        """answers lookups from the SharedCatalog `shared`, published
+        by another process, asking consul only what isn't there"""
+        self.shared = shared
+
+    def close(self):
+        """stops the background watcher and the refresh workers"""
+        if self.publisher is not None:
+            self.publisher.stop()
+            self.publisher = None
+        if self.persister is not None:
+            self.persister.stop()
+            self.persister = None
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self.strategy.close()
+
+    @property
+    def executor(self):
+        """bounded pool for concurrent consul fetches, built on first use
+        so it is never inherited across a fork"""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    @property
+    def session(self):
+        """connections to the discovered services, `pool_size` per
+        host, built on first `call`"""
+        if self._session is None:
+            import requests
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    @property
+    def negative_hits(self):
+        """lookups answered from the negative cache"""
+        return self.missing.hits
+
+    def _store(self, key, services, ttl=None):
+        """caches the instances of `key`, an Entry or the list returned
+        by consul; no instances means a negative entry"""
+        if not isinstance(services, Entry):
+            services = Entry.from_consul(services, self.scheme)
+        if services:
+            self.services.set(key, services, ttl=ttl)
+            self.missing.invalidate(key)
+        else:
+            self.services.invalidate(key)
+            self.missing.set(key, True)
+        self.generation += 1
 
     def _refresh(self):
+        """reloads every service in the catalog, fetching them
+        concurrently. A service whose fetch fails keeps its previous
+        entry; returns the list of those services"""
+        from concurrent.futures import as_completed
         log.info("Refreshing Service definitions")
-        self.services = {
-            k: self.consul.info(k)
-            for k in self.consul.list().keys()
-        }
+        start = monotonic()
+        names = set(self.consul.list().keys())
+        self.catalog.set('names', sorted(names))
+        futures = dict(
+            (self.executor.submit(self.consul.info, k,
+                                  timeout=self.fetch_timeout), k)
+            for k in names)
+        failed = []
+        for future in as_completed(futures):
+            k = futures[future]
+            try:
+                self._store(k, future.result())
+            except Exception as e:
+                failed.append(k)
+                previous = self.services.peek(k)
+                log.warning("Refresh of %s failed (%s), %s", k, e,
+                            "keeping previous entry" if previous else
+                            "no previous entry")
+                if previous:
+                    self._store(k, previous)
 
-    def register(self, service, datacenter=None, check=None, tags=None):
-        log.debug("About to register service: %s", service)
+        for k in self.services.keys():
+            if k not in names:
+                self._store(k, [])
+        self.refresh_seconds.observe(monotonic() - start)
+        self._warm = True
+        return failed
+
+    def _refresh_key(self, key):
+        """reloads only the service `key`"""
+        log.debug("Refreshing Service definition for %s", key)
+        services = Entry.from_consul(self.consul.info(key), self.scheme)
+        self._store(key, services)
+        return services
+
+    @property
+    def warm(self):
+        """True once the catalog has been fetched, or listed by the
+        watcher: lookups go to consul from then on, the snapshot only
+        answers when it can't be reached"""
+        watcher = self.watcher
+        return self._warm or (watcher is not None and watcher.synced)
+
+    @property
+    def snapshot_age(self):
+        """seconds since the snapshot on disk was written, None if
+        there is none"""
+        if self.snapshot is None or self.snapshot.current is None:
+            return None
+        return self.snapshot.current.age
+
+    def _from_snapshot(self, key):
+        """Entry of `key` in the snapshot on disk, None if it's not
+        there or the snapshot is too old"""
+        age = self.snapshot_age
+        if age is None or age > self.max_staleness:
+            return None
+        return self.snapshot.current.get(key)
+
+    def _catch_up(self):
+        """refreshes the whole catalog in background, once at a time.
+        It runs on its own thread: `_refresh` waits on the executor"""
+        if self._catching_up is not None and self._catching_up.is_alive():
+            return
+
+        def refresh():
+            try:
+                self._refresh()
+            except Exception as e:
+                log.warning("catalog refresh failed (%s)", e)
+
+        self._catching_up = threading.Thread(target=refresh,
+                                             name="catalog-catch-up")
+        self._catching_up.daemon = True
+        self._catching_up.start()
+
+    def _snapshot(self):
+        """(entries, names) to publish: the cached services, plus the
+        ones of the snapshot on disk still in the catalog, and the names
+        of the catalog if known"""
+        names = self._cached_names()
+        entries = {}
+        snapshot = self.snapshot.current if self.snapshot else None
+        if snapshot is not None:
+            for name in snapshot.names():
+                if name in self.missing or \
+                   (names is not None and name not in names):
+                    continue
+                entry = snapshot.get(name)
+                if entry:
+                    entries[name] = entry
+        entries.update(self.services.items())
+        return entries, names
+
+    def _registration(self, service, check=None, tags=None):
+        """arguments of the consul registration of `service`"""
         Node = service.node
         if check is None:
             log.debug('setting default check for %s based on TCP %s:%s ',
@@ -50,66 +323,311 @@ class ServiceDiscovery(object):
         if tags is None:
             tags = [service.id, 'v1']
 
-        # Address = service.addr
-        serviceRepr = service.consulRepr()
-        serviceRepr['Tags'] = tags
-        
-        r = self.consul.register(
+        return dict(
             id=service.id,
             address=service.addr,
             port=service.port,
             name=service.name,
+            tags=tags,
             check=check)
 
+    def register(self, service, datacenter=None, check=None, tags=None):
+        log.debug("About to register service: %s", service)
+        r = self.consul.register(**self._registration(service, check, tags))
         log.debug("Register Response: %s", r)
-        
+
     def unregister(self, service):
         log.debug("About to unregister service: %s", service)
         self.consul.deregister(id=service.id)
 
-    def getServices(self, key):
-        """get all services of type `key`"""
-        if key not in self.services:
-            self._refresh()
-            if key not in self.services:
-                return []
-        
-        services = self.services[key]
-        log.debug("%s", services)
-        return [
-            "https://{}:{}".format(
-                x['ServiceAddress'],
-                x['ServicePort'])
-            for x in services
-        ]
-
-    def getService(self, key):
-        """get a random service of type `key`"""
-        services = self.getServices(key)
+    def _txn_op(self, verb, service, tags=None):
+        """transaction operation writing `service` in the catalog"""
+        if verb == 'delete':
+            entry = {'ID': service.id}
+        else:
+            registration = self._registration(service, tags=tags)
+            entry = {
+                'ID': service.id,
+                'Service': service.name,
+                'Address': service.addr,
+                'Port': int(service.port),
+                'Tags': registration['tags']
+            }
+        return {'Service': {'Verb': verb, 'Node': service.node,
+                            'Service': entry}}
+
+    def _txn_chunks(self, verb, services, tags=None):
+        """(services, ops) of the transactions for `services`"""
+        from ServiceDiscovery.client import TXN_MAX_OPS
+        for i in range(0, len(services), TXN_MAX_OPS):
+            chunk = services[i:i + TXN_MAX_OPS]
+            yield chunk, [self._txn_op(verb, x, tags) for x in chunk]
+
+    def _forget(self, services):
+        """drops what's cached about the services of `services`"""
+        for name in set(x.name for x in services):
+            self.services.invalidate(name)
+            self.missing.invalidate(name)
+        self.catalog.clear()
+
+    def _batch(self, func, services, verb, txn, tags=None):
+        services = list(services)
+        results = []
+        if txn:
+            for chunk, ops in self._txn_chunks(verb, services, tags):
+                try:
+                    self.consul.txn(ops)
+                    error = None
+                except Exception as e:
+                    log.warning("transaction of %s services failed: %s",
+                                len(chunk), e)
+                    error = e
+                results.extend((x, error) for x in chunk)
+        else:
+            futures = [self.executor.submit(func, x) for x in services]
+            for service, future in zip(services, futures):
+                try:
+                    future.result()
+                    results.append((service, None))
+                except Exception as e:
+                    log.warning("%s of %s failed: %s", verb, service, e)
+                    results.append((service, e))
+        self._forget(services)
+        return results
+
+    def register_many(self, services, check=None, tags=None, txn=False):
+        """registers all `services`, returns a list of (service, error)
+        with error None on success.
+
+        Registrations go to the agent on `workers` parallel requests.
+        With `txn` the services are written straight in the catalog with
+        consul transactions, TXN_MAX_OPS at a time, without checks: that
+        fits external services only, as an agent removes from the catalog
+        the services of its node it doesn't know about."""
+        return self._batch(
+            lambda x: self.register(x, check=check, tags=tags),
+            services, 'set', txn, tags)
+
+    def unregister_many(self, services, txn=False):
+        """unregisters all `services`, see `register_many`"""
+        return self._batch(self.unregister, services, 'delete', txn)
+
+    def _cached_names(self):
+        """names of all services if known without asking consul"""
+        if self.shared is not None:
+            names = self.shared.names()
+            if names is not None:
+                return names
+        watcher = self.watcher
+        if watcher is not None and watcher.synced:
+            return sorted(watcher.services)
+        return self.catalog.get('names')
+
+    def listServices(self):
+        """names of all services in the catalog"""
+        names = self._cached_names()
+        if names is None:
+            names = sorted(self.consul.list().keys())
+            self.catalog.set('names', names)
+        return names
+
+    def _cached(self, key):
+        """cached Entry of `key`, EMPTY if known to be missing, None if
+        consul has to be asked"""
+        if self.shared is not None:
+            services = self.shared.get(key)
+            if services is not None:
+                return services
+        watcher = self.watcher
+        if watcher is not None:
+            watcher.touch(key)
+        services = self.services.get(key)
+        if services is None:
+            if self.missing.get(key) is not None:
+                return EMPTY
+            if watcher is not None and watcher.synced and \
+               key not in watcher.services:
+                return EMPTY
+            if not self.warm and self.snapshot is not None:
+                # starting: answer from disk while the refresh runs
+                services = self._from_snapshot(key)
+                # a shared catalog gets its refresh from the publisher
+                if services is not None and watcher is None and \
+                   self.shared is None:
+                    self._catch_up()
+        return services
+
+    @staticmethod
+    def _filters_health(status):
+        if status not in SEVERITY:
+            raise ValueError('unknown health status %r' % (status,))
+        return SEVERITY[status] < SEVERITY[CRITICAL]
+
+    def _store_health(self, checks, ttl=None):
+        health = Health.from_consul(checks)
+        self.health.set('state', health, ttl=ttl)
+        self.generation += 1
+        return health
+
+    def _pushed_health(self):
+        """(True, Health or None) when the health state comes from the
+        shared catalog or the watcher rather than from lookups"""
+        if self.shared is not None and self.shared.version:
+            return True, self.shared.health()
+        if self.watcher is not None:
+            return True, self.health.peek('state')
+        return False, None
+
+    def _health_unavailable(self, previous, e):
+        """the Health to use when it can't be read: the last one, else
+        NO_HEALTH so that nothing is filtered out. It is cached for
+        `health_ttl` seconds, so lookups don't wait on consul again"""
+        log.warning("consul health state unavailable (%s), %s", e,
+                    "using the last one" if previous else "not filtering")
+        health = previous if previous is not None else NO_HEALTH
+        self.health.set('state', health)
+        return health
+
+    def _health(self, status=PASSING):
+        """the Health lookups for `status` are filtered with, read in
+        bulk every `health_ttl` seconds; None if there is none"""
+        if not self._filters_health(status):
+            return None
+        pushed, health = self._pushed_health()
+        if pushed:
+            return health
+        # before get() drops it if expired
+        previous = self.health.peek('state')
+        health = self.health.get('state')
+        if health is None:
+            with self._health_lock:
+                # read meanwhile by the thread holding the lock
+                health = self.health.get('state')
+                if health is None:
+                    try:
+                        health = self._store_health(
+                            self.consul.health_state())
+                    except Exception as e:
+                        return self._health_unavailable(previous, e)
+        return health
+
+    def _urls(self, services, tags=(), node=None, health=None,
+              status=PASSING):
+        """urls of the not ejected instances of the Entry `services`
+        having all of `tags`, on `node` if given, and no check worse
+        than `status` in `health`"""
+        urls = services.select(tags, node)
+        if health is not None:
+            urls = health.filter(services, urls, status)
+        return self.outliers.filter(urls)
+
+    def getServices(self, key, tags=(), node=None, status=PASSING):
+        """get all services of type `key` having all of `tags`, and on
+        `node` if given, but the ejected ones, as a tuple of urls shared
+        with the cache: don't modify it.
+
+        Only the instances passing their consul checks are returned; with
+        `status` 'warning' the ones warning too, with 'critical' all"""
+        services = self._cached(key)
+        if services is None:
+            try:
+                services = self._refresh_key(key)
+            except Exception:
+                services = self._from_snapshot(key)
+                if services is None:
+                    raise
+                log.warning("consul unreachable, %s from the snapshot", key)
+        return self._urls(services, tags, node, self._health(status),
+                          status)
+
+    def _select(self, key, services, exclude=()):
+        if exclude:
+            services = [x for x in services if x not in exclude]
         if len(services) == 0:
             raise Exception('No Services found with key="%s"' % key)
-        return random.choice(services)
-
-    def call(self, key, path, ck_health=True, **kwargs):
-        base_url = self.getService(key)
-        retries = 10
-        while retries:
-            if ck_health:
-                res = requests.get(base_url + "/health", **kwargs)
-                if res.status_code != 200:
-                    # handle it
-                    self._refresh()
-                    services = self._services[key]
-                    
-                    retries -= 1
-                    
-                
-            url = "".join(base_url, path)
-            res = requests.get(url, **kwargs)
-            return res.json()
-        
+        return self.strategy.select(key, services)
+
+    def getService(self, key, exclude=(), tags=(), node=None,
+                   status=PASSING):
+        """get a service of type `key`, not in `exclude`, picked by
+        `strategy` among the ones `getServices` returns"""
+        return self._select(key, self.getServices(key, tags, node, status),
+                            exclude)
+
+    def _healthy(self, base_url, timeout):
+        import requests
+        try:
+            res = self.session.get(base_url + "/health", timeout=timeout)
+        except requests.RequestException as e:
+            log.debug("health of %s failed: %s", base_url, e)
+            return False
+        return res.status_code == 200
+
+    def call(self, key, path, method='GET', ck_health=False,
+             deadline=DEFAULT_DEADLINE, **kwargs):
+        """sends a `method` request for `path` to an instance of `key`
+        and returns its decoded JSON body.
+
+        When an instance can't be connected to the request is retried on
+        another one, until every instance has been tried or `deadline`
+        seconds have passed; IDEMPOTENT methods are retried also when
+        the connection broke after the request was sent. Outcomes feed
+        `outliers`, which ejects failing instances; `ck_health` also
+        probes /health before. Other `kwargs` go to `requests`."""
+        import requests
+        start = monotonic()
+        timeout = kwargs.pop('timeout', None)
+        tried = set()
+        # why the last instance couldn't be reached
+        error = None
+        while True:
+            remaining = deadline - (monotonic() - start)
+            if remaining <= 0:
+                raise requests.Timeout(
+                    'deadline of {}s exceeded calling {}{}'.format(
+                        deadline, key, path))
+            try:
+                base_url = self.getService(key, exclude=tried)
+            except Exception:
+                if error is None:
+                    raise
+                # every instance was tried: that's the real failure
+                raise error
+            tried.add(base_url)
+            request_timeout = remaining if timeout is None else \
+                min(timeout, remaining)
+
+            if ck_health and not self._healthy(base_url, request_timeout):
+                log.warning("%s is not healthy, trying another", base_url)
+                continue
+
+            sent = monotonic()
+            try:
+                res = self.session.request(method, base_url + path,
+                                           timeout=request_timeout,
+                                           **kwargs)
+            except requests.ConnectionError as e:
+                self.outliers.record_failure(base_url)
+                if method.upper() not in IDEMPOTENT and not _not_sent(e):
+                    # the instance may have acted on it
+                    raise
+                error = e
+                log.warning("%s failed on %s (%s), trying another",
+                            path, base_url, e)
+                continue
+            except requests.Timeout:
+                self.outliers.record_failure(base_url)
+                raise
+            if res.status_code >= 500:
+                self.outliers.record_failure(base_url)
+            else:
+                self.outliers.record_success(base_url, monotonic() - sent)
+            return res.json() if res.content else None
+
 
 class Service(object):
+    __slots__ = ('name', 'addr', 'node', 'port', 'id')
+
     def __init__(self, name, addr, port, node=None):
         self.name = name
         self.addr = addr
@@ -125,8 +643,7 @@ class Service(object):
 
     def to_dict(self):
         """Dict repr of this Service"""
-        d = {k: v for k, v in self.__dict__.iteritems() if k != "sd"}
-        return d
+        return {k: getattr(self, k) for k in self.__slots__}
 
     def __repr__(self):
         return "<Service id:%s, name:%s, addr:%s, port:%s>" % \
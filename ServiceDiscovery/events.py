@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+
+"""Catalog changes pushed to HTTP clients as server-sent events"""
+
+import os
+import time
+import logging
+import collections
+import ujson as json
+
+import tornado.web
+import tornado.gen
+import tornado.locks
+import tornado.ioloop
+import tornado.iostream
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.5
+DEFAULT_HISTORY = 1024
+DEFAULT_HEARTBEAT = 15.0
+DEFAULT_MAX_WATCHERS = 1000
+EVENT_STREAM = 'text/event-stream'
+# milliseconds browsers wait before reconnecting
+RETRY = 2000
+
+
+def _instance(x):
+    return {
+        'id': x.id,
+        'url': x.url,
+        'addr': x.addr,
+        'port': x.port,
+        'node': x.node,
+        'tags': list(x.tags)
+    }
+
+
+def diff(old, new):
+    """(added, removed, changed) instances between the Entries `old`
+    and `new`, either of which may be None"""
+    before = dict((x.id, x) for x in old or ())
+    after = dict((x.id, x) for x in new or ())
+    added = [x for id, x in after.items() if id not in before]
+    removed = [x for id, x in before.items() if id not in after]
+    changed = [
+        x for id, x in after.items()
+        if id in before and
+        (x.url, x.node, x.tags) != (before[id].url, before[id].node,
+                                    before[id].tags)]
+    return added, removed, changed
+
+
+class CatalogEvents(object):
+    """Turns the catalog known to a `ServiceDiscovery` into a sequence
+    of deltas, one per changed service, for any number of watchers.
+
+    The catalog is compared with the previous one every `interval`
+    seconds, only when the discovery says it changed: consul is never
+    asked for the watchers. Deltas are numbered `<epoch>.<seq>`, seq
+    growing by one per delta; the last `history` of them are kept, so
+    that a client reconnecting with the last id it saw gets what it
+    missed. The epoch is drawn by `start`, in the process serving the
+    streams (a forked worker has its own), and a client whose id is
+    from another epoch or too old starts again from a full snapshot."""
+
+    def __init__(self, sd, interval=DEFAULT_INTERVAL,
+                 history=DEFAULT_HISTORY):
+        self.sd = sd
+        self.interval = interval
+        self.epoch = None
+        self.seq = 0
+        self.events = collections.deque(maxlen=history)
+        self.entries = {}
+        self.changed = tornado.locks.Condition()
+        # open streams
+        self.watchers = 0
+        # set by `close`: streams end, new ones are refused
+        self.closed = False
+        self._token = None
+        self._callback = None
+
+    @property
+    def running(self):
+        return self._callback is not None
+
+    def start(self):
+        """starts following the catalog on the current IOLoop, if not
+        already"""
+        if self.running:
+            return
+        if self.epoch is None:
+            self.epoch = '{:x}{:x}'.format(int(time.time()), os.getpid())
+        if self.sd.shared is None:
+            # changes have to come from somewhere
+            self.sd.watch()
+        self.entries = self._entries()
+        self._token = self._version()
+        self._callback = tornado.ioloop.PeriodicCallback(
+            self.poll, self.interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def close(self):
+        """ends every stream, so that the server can drain"""
+        self.closed = True
+        self.stop()
+        self.changed.notify_all()
+
+    def _version(self):
+        shared = self.sd.shared
+        return self.sd.generation, shared.version if shared else 0
+
+    def _entries(self):
+        """name -> Entry of the services currently known.
+
+        The discovery cache expires and evicts its entries: a service
+        missing from it keeps its last Entry, unless the catalog dropped
+        it or its last fetch found no instance"""
+        sd = self.sd
+        shared = sd.shared
+        if shared is not None and shared.version:
+            entries = {}
+            for name in shared.names() or ():
+                entry = shared.get(name)
+                if entry:
+                    entries[name] = entry
+            return entries
+        watcher = sd.watcher
+        if watcher is not None and watcher.synced:
+            names = watcher.services
+        else:
+            names = set(self.entries).union(sd.services.keys())
+        entries = {}
+        for name in names:
+            entry = sd.services.peek(name)
+            if entry is None and name not in sd.missing:
+                entry = self.entries.get(name)
+            if entry:
+                entries[name] = entry
+        return entries
+
+    def poll(self):
+        """records the deltas since the last poll and wakes up the
+        watchers if there are any"""
+        token = self._version()
+        if token == self._token:
+            return
+        self._token = token
+        entries = self._entries()
+        count = 0
+        for name in sorted(set(self.entries) | set(entries)):
+            old, new = self.entries.get(name), entries.get(name)
+            if old is new:
+                continue
+            added, removed, changed = diff(old, new)
+            if added or removed or changed:
+                self._append(name, added, removed, changed)
+                count += 1
+        self.entries = entries
+        if count:
+            log.debug("%s catalog deltas, now at %s", count, self.last_id)
+            self.changed.notify_all()
+
+    def _append(self, name, added, removed, changed):
+        self.seq += 1
+        self.events.append((self.seq, json.dumps({
+            'service': name,
+            'added': [_instance(x) for x in added],
+            'removed': [x.id for x in removed],
+            'changed': [_instance(x) for x in changed]
+        })))
+
+    @property
+    def last_id(self):
+        return self.event_id(self.seq)
+
+    def event_id(self, seq):
+        return '{}.{}'.format(self.epoch, seq)
+
+    def since(self, last_id):
+        """the (seq, data) deltas after `last_id`, None if they aren't
+        all kept anymore, or `last_id` isn't one of this epoch"""
+        try:
+            epoch, seq = last_id.rsplit('.', 1)
+            seq = int(seq)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch or seq > self.seq:
+            return None
+        if seq == self.seq:
+            return []
+        if not self.events or self.events[0][0] > seq + 1:
+            return None
+        return [(s, data) for s, data in self.events if s > seq]
+
+    def snapshot(self):
+        """every known instance, as of `last_id`"""
+        return json.dumps(dict(
+            (name, [_instance(x) for x in entry])
+            for name, entry in self.entries.items()))
+
+
+class WatchHandler(tornado.web.RequestHandler):
+    """Streams catalog changes as server-sent events:
+
+        GET /services/watch
+
+    The stream starts with a `snapshot` event of every instance, then
+    sends a `delta` event per changed service:
+
+        {"service": ..., "added": [...], "removed": [ids],
+         "changed": [...]}
+
+    A client reconnecting with Last-Event-ID (or ?last_id=) gets the
+    deltas it missed instead of the snapshot, when they are still
+    kept. A comment is sent every `heartbeat` seconds of silence; past
+    `max_watchers` streams, or once the CatalogEvents is closed, new
+    ones get a 503."""
+
+    def initialize(self, events, heartbeat=DEFAULT_HEARTBEAT,
+                   max_watchers=DEFAULT_MAX_WATCHERS):
+        self.events = events
+        self.heartbeat = heartbeat
+        self.max_watchers = max_watchers
+        self._watching = False
+
+    def _release(self):
+        if self._watching:
+            self._watching = False
+            self.events.watchers -= 1
+
+    @property
+    def watching(self):
+        return self._watching and not self.events.closed
+
+    def on_connection_close(self):
+        self._release()
+        # wake up the stream so that it notices
+        self.events.changed.notify_all()
+
+    def on_finish(self):
+        self._release()
+
+    def _event(self, seq, data, event='delta'):
+        self.write('id: {}\nevent: {}\ndata: {}\n\n'.format(
+            self.events.event_id(seq), event, data))
+
+    @tornado.gen.coroutine
+    def get(self):
+        if self.events.closed or \
+           self.events.watchers >= self.max_watchers:
+            self.set_status(503)
+            self.set_header('Retry-After', str(RETRY // 1000))
+            self.finish({'error': 'too many watchers'
+                         if not self.events.closed else 'shutting down'})
+            return
+        self.events.watchers += 1
+        self._watching = True
+        self.events.start()
+
+        self.set_header('Content-Type', EVENT_STREAM)
+        self.set_header('Cache-Control', 'no-cache')
+        # no buffering in proxies
+        self.set_header('X-Accel-Buffering', 'no')
+        self.write('retry: {}\n\n'.format(RETRY))
+
+        last_id = self.request.headers.get('Last-Event-ID') or \
+            self.get_argument('last_id', None)
+        ioloop = tornado.ioloop.IOLoop.current()
+        while self.watching:
+            events = self.events.since(last_id)
+            if events is None:
+                self._event(self.events.seq, self.events.snapshot(),
+                            'snapshot')
+            else:
+                for seq, data in events:
+                    self._event(seq, data)
+            last_id = self.events.last_id
+            try:
+                yield self.flush()
+            except tornado.iostream.StreamClosedError:
+                break
+            woken = False
+            while not woken and self.watching:
+                woken = yield self.events.changed.wait(
+                    ioloop.time() + self.heartbeat)
+                if not woken:
+                    self.write(': heartbeat\n\n')
+                    try:
+                        yield self.flush()
+                    except tornado.iostream.StreamClosedError:
+                        self._release()
+        self._release()
+        log.debug("watcher left at %s", last_id)
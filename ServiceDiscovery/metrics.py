@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+                     .replace('"', r'\"')
+
+
+def _labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(*extra))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base of all metrics: a name, a help text and label names.
+
+    Series are keyed by the tuple of label values, in the order of
+    `labels`"""
+
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def header(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} {}'.format(self.name, self.kind)
+        ]
+
+    def expose(self):
+        """lines of the Prometheus text format"""
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def expose(self):
+        lines = self.header()
+        for labels, value in sorted(self.values.items()):
+            lines.append('{}{} {}'.format(
+                self.name, _labels(self.labels, labels), _value(value)))
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Metric read at scrape time: `read` returns a number, or a dict
+    of label values tuples to numbers"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, read, labels=(), kind=None):
+        super(CallbackMetric, self).__init__(name, help, labels)
+        self.read = read
+        if kind is not None:
+            self.kind = kind
+
+    def expose(self):
+        lines = self.header()
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            lines.append('{}{} {}'.format(
+                self.name, _labels(self.labels, labels), _value(value)))
+        return lines
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket..., count above, sum]
+        self.series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(labels)
+            if series is None:
+                series = self.series[labels] = \
+                    [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def expose(self):
+        lines = self.header()
+        bounds = [_value(b) for b in self.buckets] + ['+Inf']
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(bounds, series):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(self.labels, labels, ('le', bound)),
+                    cumulative))
+            label_str = _labels(self.labels, labels)
+            lines.append('{}_sum{} {}'.format(self.name, label_str,
+                                              _value(series[-1])))
+            lines.append('{}_count{} {}'.format(self.name, label_str,
+                                                cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """adds `metric`, in place of the one of the same name if
+        any, so that registering again doesn't expose it twice"""
+        for i, registered in enumerate(self.metrics):
+            if registered.name == metric.name:
+                self.metrics[i] = metric
+                return metric
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    'http_requests_total',
+    'HTTP requests served',
+    labels=('handler', 'method', 'code')))
+
+LATENCY = REGISTRY.register(Histogram(
+    'http_request_duration_seconds',
+    'Time spent serving HTTP requests',
+    labels=('handler', 'method')))
+
+
+def discovery_metrics(sd):
+    """metrics reading the internals of the ServiceDiscovery `sd`"""
+    def cache(counter):
+        return lambda: {
+            ('positive',): sd.services.info()[counter],
+            ('negative',): sd.missing.info()[counter]
+        }
+
+    return [
+        CallbackMetric(
+            'servicediscovery_consul_requests_total',
+            'Round trips to consul',
+            lambda: sd.consul.round_trips, kind='counter'),
+        CallbackMetric(
+            'servicediscovery_cache_hits_total', 'Cache hits',
+            cache('hits'), labels=('cache',), kind='counter'),
+        CallbackMetric(
+            'servicediscovery_cache_misses_total', 'Cache misses',
+            cache('misses'), labels=('cache',), kind='counter'),
+        CallbackMetric(
+            'servicediscovery_cache_evictions_total', 'LRU evictions',
+            cache('evictions'), labels=('cache',), kind='counter'),
+        CallbackMetric(
+            'servicediscovery_cache_size', 'Cached services',
+            cache('size'), labels=('cache',)),
+        CallbackMetric(
+            'servicediscovery_ejected_instances',
+            'Instances ejected by outlier detection',
+            lambda: sd.outliers.ejected_count()),
+        CallbackMetric(
+            'servicediscovery_snapshot_age_seconds',
+            'Age of the catalog snapshot on disk',
+            lambda: {} if sd.snapshot_age is None else sd.snapshot_age),
+        sd.refresh_seconds
+    ]
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_FAILURES = 3
+DEFAULT_BASE_EJECTION = 10.0
+DEFAULT_MAX_EJECTION = 300.0
+# weight of the last call in the latency moving average
+LATENCY_ALPHA = 0.2
+
+
+class InstanceState(object):
+    __slots__ = ('failures', 'ejections', 'ejected_until', 'latency',
+                 'calls')
+
+    def __init__(self):
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = None
+        self.latency = None
+        self.calls = 0
+
+
+class OutlierDetector(object):
+    """Passive health tracking of instances from the outcome of real calls.
+
+    After `max_failures` consecutive failures an instance is ejected for
+    `base_ejection` seconds, doubling on every new ejection up to
+    `max_ejection`. Once that time passes the instance is half-open: it
+    gets traffic again, and the first failure ejects it right away while
+    the first success brings it back to healthy.
+
+    Failures of calls in flight while the instance is ejected don't
+    eject it again. When every instance is ejected `filter` keeps them
+    all: some traffic beats none."""
+
+    def __init__(self, max_failures=DEFAULT_MAX_FAILURES,
+                 base_ejection=DEFAULT_BASE_EJECTION,
+                 max_ejection=DEFAULT_MAX_EJECTION, timer=monotonic):
+        self.max_failures = max_failures
+        self.base_ejection = base_ejection
+        self.max_ejection = max_ejection
+        self.timer = timer
+        self.instances = {}
+        self._ejected = set()
+        self._lock = threading.Lock()
+
+    def _state(self, url):
+        state = self.instances.get(url)
+        if state is None:
+            state = self.instances.setdefault(url, InstanceState())
+        return state
+
+    def record_success(self, url, latency=None):
+        with self._lock:
+            state = self._state(url)
+            state.calls += 1
+            state.failures = 0
+            if state.ejections:
+                log.info("%s is healthy again", url)
+            state.ejections = 0
+            state.ejected_until = None
+            self._ejected.discard(url)
+            if latency is not None:
+                if state.latency is None:
+                    state.latency = latency
+                else:
+                    state.latency += LATENCY_ALPHA * (latency - state.latency)
+
+    def record_failure(self, url):
+        with self._lock:
+            state = self._state(url)
+            state.calls += 1
+            state.failures += 1
+            if state.ejected_until is not None and \
+               state.ejected_until > self.timer():
+                # already out, sent before the ejection
+                return
+            if state.failures >= self.max_failures or state.ejections:
+                self._eject(url, state)
+
+    def _eject(self, url, state):
+        timeout = min(self.base_ejection * 2 ** state.ejections,
+                      self.max_ejection)
+        state.ejections += 1
+        state.ejected_until = self.timer() + timeout
+        self._ejected.add(url)
+        log.warning("ejecting %s for %ss after %s failures", url, timeout,
+                    state.failures)
+
+    def ejected(self, url):
+        """True while `url` is ejected"""
+        if url not in self._ejected:
+            return False
+        with self._lock:
+            state = self.instances[url]
+            if state.ejected_until is not None and \
+               state.ejected_until > self.timer():
+                return True
+            # half-open: let it take traffic again
+            self._ejected.discard(url)
+            return False
+
+    def ejected_count(self):
+        """how many instances are ejected now, changing nothing"""
+        now = self.timer()
+        return sum(1 for s in list(self.instances.values())
+                   if s.ejected_until is not None and s.ejected_until > now)
+
+    def filter(self, urls):
+        """`urls` without the ejected ones; `urls` itself when none is,
+        or when all are"""
+        if not self._ejected:
+            return urls
+        healthy = tuple(url for url in urls if not self.ejected(url))
+        if not healthy and urls:
+            log.warning("all %s instances ejected, using them all",
+                        len(urls))
+            return urls
+        return healthy
+
+    def state(self):
+        """per instance health, for inspection"""
+        now = self.timer()
+        return dict(
+            (url, {
+                'calls': s.calls,
+                'failures': s.failures,
+                'ejections': s.ejections,
+                'ejected': s.ejected_until is not None and
+                s.ejected_until > now,
+                'ejected_for': max(0.0, s.ejected_until - now)
+                if s.ejected_until is not None else 0.0,
+                'latency': s.latency
+            })
+            for url, s in list(self.instances.items()))
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+
+"""Catalog snapshots shared by pre-forked processes through memory,
+or persisted on disk"""
+
+import os
+import json
+import mmap
+import time
+import struct
+import logging
+import threading
+
+from ServiceDiscovery.catalog import Instance, Entry, EMPTY, Health
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 16 * 1024 * 1024
+DEFAULT_INTERVAL = 0.5
+# sequence number, length of the index, length of the whole payload,
+# publication time
+HEADER = struct.Struct('<QIId')
+# reads retried while the writer is busy before giving up on them
+READ_RETRIES = 100
+
+
+class _View(object):
+    """A published snapshot as seen by a reader: the index is decoded
+    once per version, each entry the first time it is asked for"""
+
+    __slots__ = ('seq', 'index', 'complete', 'health', 'base', 'entries')
+
+    def __init__(self, seq, index, base):
+        self.seq = seq
+        self.index = index['services']
+        self.complete = index['complete']
+        self.health = _health(index.get('health'))
+        self.base = base
+        self.entries = {}
+
+
+def _health(data):
+    """the Health published as `data`, see `_payload`"""
+    if data is None:
+        return None
+    nodes, checks = data
+    services = {}
+    for name, node, id, severity in checks:
+        services.setdefault(name, {})[(node, id)] = severity
+    return Health(nodes, services)
+
+
+def _payload(entries, names, health=None):
+    """(index, whole payload) of a snapshot of `entries`, a dict of
+    name -> Entry, `names`, the catalog or None if unknown, and
+    `health`, a Health if known"""
+    offset = 0
+    index = dict((name, None) for name in names or ())
+    blobs = []
+    for name, entry in entries.items():
+        data = json.dumps([
+            [x.id, x.name, x.addr, x.port, x.node, x.tags, x.url]
+            for x in entry]).encode('utf-8')
+        index[name] = (offset, len(data))
+        offset += len(data)
+        blobs.append(data)
+    if health is not None:
+        health = [health.nodes, [
+            [name, node, id, severity]
+            for name, instances in health.services.items()
+            for (node, id), severity in instances.items()]]
+    head = json.dumps({
+        'services': index,
+        'complete': names is not None,
+        'health': health
+    }).encode('utf-8')
+    return head, head + b''.join(blobs)
+
+
+class Snapshot(object):
+    """Read side of a catalog snapshot laid out in the buffer `mm`.
+
+    The layout is a HEADER followed by a JSON index of name -> (offset,
+    length) and one JSON blob per service, so readers only decode what
+    they use. A complete snapshot also lists the services of the
+    catalog not loaded yet, with no blob; from an incomplete one a
+    missing service is unknown rather than gone.
+
+    Writes follow a seqlock: the writer makes the sequence number odd,
+    writes the payload, then makes it even again. Readers never lock
+    nor copy the buffer on lookups: they compare the sequence number
+    with the one they decoded, and retry the reads which overlapped a
+    write."""
+
+    def __init__(self, mm):
+        self.mm = mm
+        self._view = None
+
+    @property
+    def version(self):
+        """sequence number of the published snapshot, 0 if none yet"""
+        return HEADER.unpack_from(self.mm, 0)[0]
+
+    @property
+    def age(self):
+        """seconds since the snapshot was published, None if it wasn't"""
+        seq, _, _, published = HEADER.unpack_from(self.mm, 0)
+        if seq == 0:
+            return None
+        return max(0.0, time.time() - published)
+
+    def _current(self):
+        """the _View of the published snapshot, None if there is none"""
+        view = self._view
+        for _ in range(READ_RETRIES):
+            seq, head_len, _, _ = HEADER.unpack_from(self.mm, 0)
+            if view is not None and view.seq == seq:
+                return view
+            if seq == 0:
+                return None
+            if seq & 1:
+                time.sleep(0.001)
+                continue
+            head = self.mm[HEADER.size:HEADER.size + head_len]
+            if self.version != seq:
+                continue
+            view = self._view = _View(seq, json.loads(head.decode('utf-8')),
+                                      HEADER.size + head_len)
+            return view
+        log.warning("catalog snapshot busy, using version %s",
+                    view.seq if view else None)
+        return view
+
+    def names(self):
+        """names of the published services, None if nothing is"""
+        view = self._current()
+        if view is None:
+            return None
+        return sorted(view.index)
+
+    def health(self):
+        """published Health of the instances, None if there is none"""
+        view = self._current()
+        return view.health if view is not None else None
+
+    def get(self, key):
+        """published Entry of `key`, EMPTY if it isn't in the catalog,
+        None if it isn't known or nothing is published yet"""
+        for _ in range(READ_RETRIES):
+            view = self._current()
+            if view is None:
+                return None
+            entry = view.entries.get(key)
+            if entry is not None:
+                return entry
+            if key not in view.index:
+                return EMPTY if view.complete else None
+            loc = view.index[key]
+            if loc is None:
+                return None
+            start = view.base + loc[0]
+            data = self.mm[start:start + loc[1]]
+            if self.version != view.seq:
+                # overwritten while reading it
+                continue
+            entry = view.entries[key] = Entry(
+                Instance(id, name, addr, port, node, tuple(tags), url)
+                for id, name, addr, port, node, tags, url
+                in json.loads(data.decode('utf-8')))
+            return entry
+        return None
+
+
+class SharedCatalog(Snapshot):
+    """The catalog published by one process into an anonymous shared
+    mmap, readable by every process forked after it was built"""
+
+    def __init__(self, size=DEFAULT_SIZE):
+        super(SharedCatalog, self).__init__(mmap.mmap(-1, size))
+        self.size = size
+
+    def publish(self, entries, names=None, health=None):
+        """publishes `entries`, a dict of name -> Entry, `names`, the
+        catalog if known, and `health`, a Health if known. Returns False
+        if they don't fit"""
+        head, payload = _payload(entries, names, health)
+        if HEADER.size + len(payload) > self.size:
+            log.error("catalog snapshot of %s bytes doesn't fit in %s",
+                      len(payload), self.size)
+            return False
+
+        seq = self.version
+        # a writer killed in the middle left it odd already
+        if not seq & 1:
+            seq += 1
+        HEADER.pack_into(self.mm, 0, seq, 0, 0, 0.0)
+        self.mm[HEADER.size:HEADER.size + len(payload)] = payload
+        HEADER.pack_into(self.mm, 0, seq + 1, len(head), len(payload),
+                         time.time())
+        log.debug("published catalog snapshot %s: %s services, %s bytes",
+                  seq + 1, len(entries), len(payload))
+        return True
+
+
+class SnapshotFile(object):
+    """The catalog persisted to `path`, to start warm and to survive
+    consul outages. A new snapshot is written aside then renamed over
+    the previous one, so readers never see a partial file; the current
+    one is mmap'ed, so loading it costs nothing until lookups use it."""
+
+    def __init__(self, path):
+        self.path = path
+        self._current = None
+        self._loaded = False
+
+    @property
+    def current(self):
+        """the Snapshot on disk, None if there is none or it's broken"""
+        if not self._loaded:
+            self._current = self.load()
+            self._loaded = True
+        return self._current
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            # ValueError: the file is empty
+            log.info("no catalog snapshot in %s (%s)", self.path, e)
+            return None
+        snapshot = Snapshot(mm)
+        try:
+            seq, head_len, length, _ = HEADER.unpack_from(mm, 0)
+            if seq & 1 or len(mm) != HEADER.size + length or \
+               snapshot.names() is None:
+                raise ValueError('truncated')
+        except (struct.error, ValueError) as e:
+            log.warning("ignoring broken catalog snapshot %s (%s)",
+                        self.path, e)
+            return None
+        log.info("loaded catalog snapshot %s, %.0fs old", self.path,
+                 snapshot.age)
+        return snapshot
+
+    def publish(self, entries, names=None, health=None):
+        """writes `entries`, `names` and `health` as the snapshot, see
+        SharedCatalog.publish. Returns False if writing failed"""
+        head, payload = _payload(entries, names, health)
+        tmp = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(HEADER.pack(2, len(head), len(payload), time.time()))
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            log.error("can't write catalog snapshot %s (%s)", self.path, e)
+            return False
+        self._current = self.load()
+        self._loaded = True
+        return True
+
+
+class Publisher(object):
+    """Publishes the catalog known to a `ServiceDiscovery` into
+    `target`, a SharedCatalog or a SnapshotFile, from a background
+    thread, every `interval` seconds if it changed"""
+
+    def __init__(self, sd, target, interval=DEFAULT_INTERVAL):
+        self.sd = sd
+        self.target = target
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name="catalog-publisher")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        published = None
+        while not self._stopped.is_set():
+            generation = self.sd.generation
+            if generation != published:
+                entries, names = self.sd._snapshot()
+                if self.target.publish(entries, names,
+                                       self.sd.health.peek('state')):
+                    published = generation
+            self._stopped.wait(self.interval)
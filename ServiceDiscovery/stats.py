@@ -1,31 +1,121 @@
 import json
+import time
 import tornado.web
+import tornado.ioloop
 
+from collections import deque
 from psutil import cpu_percent, virtual_memory
 
+DEFAULT_INTERVAL = 1.0
+WINDOWS = {
+    '1m': 60,
+    '5m': 300,
+    '15m': 900
+}
+METRICS = ['cpu', 'memory_percent', 'memory_used', 'memory_available',
+           'index']
+
+
+def sample():
+    """current load of this host"""
+    vm = virtual_memory()
+    cpu = float(cpu_percent())
+    return {
+        'time': time.time(),
+        'cpu': cpu,
+        'memory_percent': vm.percent,
+        'memory_used': vm.used,
+        'memory_available': vm.available,
+        'index': cpu * vm.percent
+    }
+
+
+def summary(values):
+    """min, avg, max and 95th percentile of `values`"""
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        'min': values[0],
+        'avg': sum(values) / float(len(values)),
+        'max': values[-1],
+        'p95': values[int(0.95 * (len(values) - 1))]
+    }
+
+
+class StatsSampler(object):
+    """Samples the load every `interval` seconds on the IOLoop, keeping
+    enough samples for the longest of WINDOWS.
+
+    `cpu` is the utilization over the last interval, instead of since
+    the previous HTTP request."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        size = int(max(WINDOWS.values()) / interval) + 1
+        self.samples = deque(maxlen=size)
+        self._callback = None
+
+    @property
+    def running(self):
+        return self._callback is not None
+
+    def start(self):
+        """starts sampling on the current IOLoop, if not already"""
+        if self.running:
+            return
+        cpu_percent()
+        self.sample()
+        self._callback = tornado.ioloop.PeriodicCallback(
+            self.sample, self.interval * 1000)
+        self._callback.start()
+
+    def stop(self):
+        if self._callback is not None:
+            self._callback.stop()
+            self._callback = None
+
+    def sample(self):
+        self.samples.append(sample())
+
+    @property
+    def latest(self):
+        return self.samples[-1] if self.samples else None
+
+    def history(self, window):
+        """summary of every metric over the last `window` seconds"""
+        since = time.time() - window
+        samples = [s for s in self.samples if s['time'] >= since]
+        ret = dict(
+            (metric, summary([s[metric] for s in samples]))
+            for metric in METRICS)
+        ret['samples'] = len(samples)
+        return ret
+
 
 class StatsHandler(tornado.web.RequestHandler):
+    def initialize(self, sampler):
+        self.sampler = sampler
+        self.sampler.start()
+
     @classmethod
-    def routes(cls):
+    def routes(cls, sampler=None):
+        """routes sharing one StatsSampler"""
+        if sampler is None:
+            sampler = StatsSampler()
+        kwargs = dict(sampler=sampler)
         return [
-            (r'/stats/(.*)', cls),
-            (r'/stats', cls)
+            (r'/stats/history', StatsHistoryHandler, kwargs),
+            (r'/stats/(.*)', cls, kwargs),
+            (r'/stats', cls, kwargs)
         ]
 
     def set_default_headers(self):
         self.set_header('Content-Type', 'application/json')
 
     def get(self, key=None):
-        vm = virtual_memory()
-        cpu = float(cpu_percent())
-
-        stats = {
-            'cpu': cpu,
-            'memory_percent': vm.percent,
-            'memory_used': vm.used,
-            'memory_available': vm.available,
-            'index': cpu * vm.percent
-        }
+        stats = dict(self.sampler.latest)
+        del stats['time']
 
         if key is None:
             ret = stats
@@ -34,6 +124,19 @@ class StatsHandler(tornado.web.RequestHandler):
                 ret = stats[key]
             else:
                 raise tornado.web.HTTPError(404)
-            
+
         self.finish(json.dumps(ret))
 
+
+class StatsHistoryHandler(StatsHandler):
+    """min/avg/max/p95 of every stat over the last `window` (1m, 5m or
+    15m)"""
+
+    def get(self):
+        window = self.get_argument('window', '1m')
+        if window not in WINDOWS:
+            raise tornado.web.HTTPError(
+                400, 'window must be one of %s', ', '.join(sorted(WINDOWS)))
+        ret = self.sampler.history(WINDOWS[window])
+        ret['window'] = window
+        self.finish(json.dumps(ret))
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+
+"""Pre-fork supervision of the worker processes of a Tornado server"""
+
+import os
+import time
+import random
+import signal
+import logging
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.httputil
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DRAIN_TIMEOUT = 10.0
+DEFAULT_MAX_RESTARTS = 100
+# how often the supervisor looks for exited workers
+POLL_INTERVAL = 0.1
+# time left to workers past the drain timeout before killing them
+KILL_GRACE = 2.0
+STOP_SIGNALS = (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT)
+
+
+class _Counted(tornado.httputil.HTTPMessageDelegate):
+    """`delegate` of a request counted in flight by `application`,
+    telling it when the connection closes before the request is read"""
+
+    def __init__(self, application, request, delegate):
+        self.application = application
+        self.request = request
+        self.delegate = delegate
+
+    def headers_received(self, start_line, headers):
+        return self.delegate.headers_received(start_line, headers)
+
+    def data_received(self, chunk):
+        return self.delegate.data_received(chunk)
+
+    def finish(self):
+        self.delegate.finish()
+
+    def on_connection_close(self):
+        # no handler will log this request
+        self.application.done(self.request)
+        self.delegate.on_connection_close()
+
+
+class DrainingApplication(tornado.web.Application):
+    """Application counting the requests in flight, so that a worker
+    can wait for them before exiting"""
+
+    def __init__(self, *args, **kwargs):
+        super(DrainingApplication, self).__init__(*args, **kwargs)
+        self.inflight = 0
+
+    def find_handler(self, request, **kwargs):
+        # called once the headers of a request are in
+        self.inflight += 1
+        return _Counted(self, request, super(
+            DrainingApplication, self).find_handler(request, **kwargs))
+
+    def done(self, request):
+        """`request` isn't in flight anymore, counted once"""
+        if not getattr(request, '_drained', False):
+            request._drained = True
+            self.inflight -= 1
+
+    def log_request(self, handler):
+        self.done(handler.request)
+        super(DrainingApplication, self).log_request(handler)
+
+
+@tornado.gen.coroutine
+def drain(server, application, timeout=DEFAULT_DRAIN_TIMEOUT):
+    """stops accepting connections on `server`, then waits up to
+    `timeout` seconds for the requests in flight in `application`, a
+    DrainingApplication, to finish"""
+    server.stop()
+    deadline = monotonic() + timeout
+    while application.inflight > 0 and monotonic() < deadline:
+        yield tornado.gen.sleep(0.05)
+    if application.inflight > 0:
+        log.warning("drain timeout, dropping %s requests",
+                    application.inflight)
+    try:
+        yield tornado.gen.with_timeout(
+            tornado.ioloop.IOLoop.current().time() + 1,
+            server.close_all_connections())
+    except tornado.gen.TimeoutError:
+        pass
+
+
+class Supervisor(object):
+    """Runs `worker(task_id)` in `nproc` forked processes and keeps them
+    running: a worker that crashes is forked again, up to
+    `max_restarts` times in total.
+
+    `register` runs once in the supervisor before forking. On SIGTERM
+    (or SIGINT, SIGQUIT) the supervisor calls `deregister` first, so
+    that no new traffic comes, then sends SIGTERM to the workers, which
+    are expected to drain and exit; the ones still running after
+    `drain_timeout` seconds are killed."""
+
+    def __init__(self, worker, nproc=None, register=None, deregister=None,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+                 max_restarts=DEFAULT_MAX_RESTARTS):
+        if not nproc:
+            from multiprocessing import cpu_count
+            nproc = cpu_count()
+        self.worker = worker
+        self.nproc = nproc
+        self.register = register
+        self.deregister = deregister
+        self.drain_timeout = drain_timeout
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        # pid -> task id
+        self.children = {}
+        self._stopping = False
+        self._registered = False
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _spawn(self, task_id):
+        pid = os.fork()
+        if pid == 0:
+            for sig in STOP_SIGNALS:
+                signal.signal(sig, signal.SIG_DFL)
+            random.seed()
+            code = 0
+            try:
+                self.worker(task_id)
+            except Exception:
+                log.exception("worker %s failed", task_id)
+                code = 1
+            logging.shutdown()
+            os._exit(code)
+        log.info("started worker %s (PID: %s)", task_id, pid)
+        self.children[pid] = task_id
+
+    def _reap(self, respawn=True):
+        """collects the exited workers, forking again the crashed ones
+        if `respawn`"""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                # no child left
+                return
+            if pid == 0:
+                return
+            task_id = self.children.pop(pid, None)
+            if task_id is None:
+                continue
+            if os.WIFSIGNALED(status):
+                log.warning("worker %s (PID: %s) killed by signal %s",
+                            task_id, pid, os.WTERMSIG(status))
+            elif os.WEXITSTATUS(status) != 0:
+                log.warning("worker %s (PID: %s) exited with status %s",
+                            task_id, pid, os.WEXITSTATUS(status))
+            else:
+                log.info("worker %s (PID: %s) exited", task_id, pid)
+                continue
+            if respawn and not self._stopping:
+                self.restarts += 1
+                if self.restarts > self.max_restarts:
+                    raise RuntimeError("Too many child restarts, giving up")
+                self._spawn(task_id)
+
+    def _deregister(self):
+        if self._registered and self.deregister is not None:
+            self._registered = False
+            try:
+                self.deregister()
+            except Exception:
+                log.exception("deregistration failed")
+
+    def _terminate(self):
+        log.info("stopping: deregistered, draining %s workers",
+                 len(self.children))
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        deadline = monotonic() + self.drain_timeout + KILL_GRACE
+        while self.children and monotonic() < deadline:
+            self._reap(respawn=False)
+            time.sleep(POLL_INTERVAL)
+        for pid, task_id in list(self.children.items()):
+            log.warning("worker %s (PID: %s) didn't drain in time, "
+                        "killing it", task_id, pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+            self.children.pop(pid, None)
+
+    def run(self):
+        """registers, runs the workers until a stop signal, then
+        deregisters and drains them. If registering raises, no worker
+        is started and the exception propagates"""
+        for sig in STOP_SIGNALS:
+            signal.signal(sig, self._stop)
+        if self.register is not None:
+            self.register()
+            self._registered = True
+        try:
+            for task_id in range(self.nproc):
+                self._spawn(task_id)
+            while self.children and not self._stopping:
+                self._reap()
+                time.sleep(POLL_INTERVAL)
+            self._deregister()
+            self._terminate()
+        finally:
+            self._deregister()
+            for pid in list(self.children):
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+        log.info("all workers stopped")
@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+from collections import OrderedDict
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from ServiceDiscovery.catalog import Entry
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WAIT = 300
+DEFAULT_RETRY = 5.0
+# services long-polled at once, each on its own connection: a consul
+# agent accepts 200 connections per client address by default
+DEFAULT_MAX_WATCHES = 64
+# keys of the health checks watch and of the sweeper among the service
+# ones: service names have no slash
+HEALTH = '/health'
+SWEEP = '/sweep'
+
+
+def _same(old, new):
+    """True if the Entries `old` and `new` hold the same instances"""
+    if old is None:
+        return False
+    return [(x.id, x.url, x.node, x.tags) for x in old] == \
+        [(x.id, x.url, x.node, x.tags) for x in new]
+
+
+class CatalogWatcher(object):
+    """Keeps a `ServiceDiscovery` warm with Consul blocking queries.
+
+    One thread long-polls the catalog; up to `max_watches` services get
+    their own thread long-polling `/v1/catalog/service/<name>`, storing
+    each change into the discovery cache as it arrives. One more
+    long-polls the health checks of the whole catalog.
+
+    Services are watched as the catalog lists them while there is room,
+    then the least recently looked up ones give way to those looked up,
+    see `touch`. A last thread fetches the others as soon as they are
+    listed, then again every `interval` seconds (the TTL of the
+    discovery by default), so that the discovery holds the whole
+    catalog."""
+
+    def __init__(self, sd, wait=DEFAULT_WAIT, retry=DEFAULT_RETRY,
+                 max_watches=DEFAULT_MAX_WATCHES, interval=None):
+        self.sd = sd
+        self.wait = wait
+        self.retry = retry
+        self.max_watches = max_watches
+        if interval is None:
+            interval = sd.services.ttl
+        self.interval = interval
+        self.services = frozenset()
+        self._threads = {}
+        # services to watch, least recently looked up first
+        self._watched = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._synced = threading.Event()
+        # set when the catalog lists new services
+        self._listed = threading.Event()
+
+    @property
+    def synced(self):
+        """True once the catalog has been listed at least once"""
+        return self._synced.is_set()
+
+    def wait_synced(self, timeout=None):
+        return self._synced.wait(timeout)
+
+    def start(self):
+        log.info("Starting catalog watcher")
+        self._spawn(None, self._watch_catalog)
+        self._spawn(HEALTH, self._watch_health)
+        self._spawn(SWEEP, self._sweep)
+
+    def stop(self):
+        log.info("Stopping catalog watcher")
+        self._stopped.set()
+        self._listed.set()
+
+    @property
+    def running(self):
+        return not self._stopped.is_set()
+
+    def _spawn(self, key, target, *args):
+        t = threading.Thread(target=target, args=args,
+                             name="watch-{}".format(key or "catalog"))
+        t.daemon = True
+        self._threads[key] = t
+        t.start()
+
+    def _poll(self, fetch, index):
+        """runs a blocking `fetch`, returns (index, data) or None on
+        error. Follows consul rules for index resets"""
+        try:
+            new_index, data = fetch(index, self.wait)
+        except Exception as e:
+            log.warning("watch failed (%s), retrying in %ss", e, self.retry)
+            self._stopped.wait(self.retry)
+            return None
+        if new_index is None or (index is not None and new_index < index):
+            new_index = 0
+        return new_index, data
+
+    def _watch_catalog(self):
+        index = None
+        while self.running:
+            res = self._poll(self.sd.consul.watch_list, index)
+            if res is None:
+                continue
+            new_index, data = res
+            if new_index != index:
+                self._update_catalog(frozenset(data.keys()))
+            index = new_index
+            self._synced.set()
+
+    def _watch_health(self):
+        index = None
+        while self.running:
+            res = self._poll(self.sd.consul.watch_health_state, index)
+            if res is None:
+                continue
+            new_index, data = res
+            if new_index != index:
+                self.sd._store_health(data, ttl=float('inf'))
+            index = new_index
+
+    def _update_catalog(self, names):
+        added = names - self.services
+        removed = self.services - names
+        self.services = names
+        with self._lock:
+            for name in removed:
+                log.info("service %s left the catalog", name)
+                self._watched.pop(name, None)
+                self.sd._store(name, [])
+            for name in sorted(added):
+                if len(self._watched) >= self.max_watches:
+                    break
+                self._watched[name] = True
+            self._start_watches()
+        if added:
+            self._listed.set()
+
+    def touch(self, name):
+        """`name` was looked up: watch it, in place of the least
+        recently looked up service if there is no room"""
+        if self.max_watches <= 0 or name not in self.services or \
+           not self.running:
+            return
+        with self._lock:
+            if self._watched.pop(name, False):
+                self._watched[name] = True
+                return
+            if len(self._watched) >= self.max_watches:
+                evicted, _ = self._watched.popitem(last=False)
+                log.debug("not watching service %s anymore", evicted)
+            self._watched[name] = True
+            self._start_watches()
+
+    def _watching(self):
+        """services with a watch running, the ones left watching too"""
+        return [k for k, t in list(self._threads.items())
+                if k not in (None, HEALTH, SWEEP) and t.is_alive()]
+
+    def _start_watches(self):
+        """starts the watches of `_watched` not running yet, as long as
+        less than `max_watches` are. The ones left finish their current
+        poll first, then make room"""
+        running = self._watching()
+        room = self.max_watches - len(running)
+        for name in self._watched:
+            if room <= 0:
+                break
+            if name in running:
+                continue
+            log.info("watching service %s", name)
+            self._spawn(name, self._watch_service, name)
+            room -= 1
+
+    def _watch_service(self, name):
+        index = None
+
+        def fetch(index, wait):
+            return self.sd.consul.watch_info(name, index, wait)
+
+        def watched():
+            return self.running and name in self.services and \
+                name in self._watched
+
+        while watched():
+            res = self._poll(fetch, index)
+            if res is None:
+                continue
+            new_index, data = res
+            if new_index != index and watched():
+                self.sd._store(name, data, ttl=float('inf'))
+            index = new_index
+
+        with self._lock:
+            # this thread is done: make room for the ones waiting
+            self._threads.pop(name, None)
+            if self.running:
+                self._start_watches()
+
+    def _unwatched(self):
+        watching = set(self._watching())
+        return [x for x in self.services if x not in watching]
+
+    def _sweep(self):
+        """fetches the services of the catalog not watched: the ones
+        not fetched yet as soon as they are listed, all of them every
+        `interval` seconds"""
+        due = 0
+        while self.running:
+            self._listed.clear()
+            if monotonic() >= due:
+                due = monotonic() + self.interval
+                names = self._unwatched()
+            else:
+                names = [x for x in self._unwatched()
+                         if self.sd.services.peek(x) is None and
+                         x not in self.sd.missing]
+            if names:
+                self._refresh(names)
+            self._listed.wait(max(0.0, due - monotonic()))
+
+    def _refresh(self, names):
+        """fetches `names` concurrently on the executor of the
+        discovery, storing the ones that changed. A service whose fetch
+        fails keeps its previous entry"""
+        try:
+            futures = [
+                (name, self.sd.executor.submit(
+                    self.sd.consul.info, name,
+                    timeout=self.sd.fetch_timeout))
+                for name in names]
+        except RuntimeError:
+            # the executor is shut down: closing
+            return
+        for name, future in futures:
+            try:
+                entry = Entry.from_consul(future.result(), self.sd.scheme)
+            except Exception as e:
+                log.warning("refresh of %s failed (%s)", name, e)
+                continue
+            if name in self.services and \
+               not _same(self.sd.services.peek(name), entry):
+                self.sd._store(name, entry, ttl=float('inf'))
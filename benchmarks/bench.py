@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+"""
+bench
+-----
+
+Benchmarks of ServiceDiscovery against an in-process fake consul.
+
+    python -m benchmarks.bench --services 300 --instances 3 -o bench.json
+
+Results are written as JSON, to compare them run to run.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import logging
+import argparse
+import platform
+
+import tornado.gen
+import tornado.web
+import tornado.ioloop
+import tornado.httpclient
+
+from tests.fakeconsul import FakeConsul
+
+from ServiceDiscovery import app
+from ServiceDiscovery.controllers import ConfigHandler
+from ServiceDiscovery.discovery import ServiceDiscovery, Service
+from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery
+
+log = logging.getLogger(__name__)
+
+
+def summarize(durations, elapsed=None):
+    """latency figures, in milliseconds, of `durations` in seconds"""
+    durations = sorted(durations)
+    n = len(durations)
+    if elapsed is None:
+        elapsed = sum(durations)
+    return {
+        'count': n,
+        'mean_ms': 1000.0 * sum(durations) / n,
+        'p50_ms': 1000.0 * durations[int(0.50 * (n - 1))],
+        'p95_ms': 1000.0 * durations[int(0.95 * (n - 1))],
+        'max_ms': 1000.0 * durations[-1],
+        'ops_per_sec': n / elapsed if elapsed else None
+    }
+
+
+def timed(func, repeat):
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+
+def seeded_consul(services, instances, ports=None):
+    """a started FakeConsul with `services` x `instances` instances"""
+    consul = FakeConsul().start()
+    if ports is None:
+        consul.seed(services, instances)
+    else:
+        for i in range(services):
+            for j in range(instances):
+                consul.add('service{}'.format(i), '127.0.0.1',
+                           ports[j % len(ports)],
+                           id='service{}-{}'.format(i, j))
+    return consul
+
+
+def bench_lookups(args):
+    consul = seeded_consul(args.services, args.instances)
+    keys = ['service{}'.format(i) for i in range(args.services)]
+    sd = ServiceDiscovery(endpoint=consul.url)
+    try:
+        def cold():
+            sd.services.clear()
+            sd.getServices(keys[0])
+
+        results = {
+            'getServices_cold': summarize(timed(cold, args.repeat)),
+            'getServices_warm': summarize(timed(
+                lambda: sd.getServices(keys[0]), args.repeat * 100)),
+            'getService_warm': summarize(timed(
+                lambda: sd.getService(keys[0]), args.repeat * 100))
+        }
+    finally:
+        sd.close()
+        consul.stop()
+    return results
+
+
+def bench_refresh(args):
+    results = {}
+    for size in args.sizes:
+        consul = seeded_consul(size, args.instances)
+        sd = ServiceDiscovery(endpoint=consul.url)
+        try:
+            results[str(size)] = summarize(timed(sd._refresh, 3))
+        finally:
+            sd.close()
+            consul.stop()
+    return results
+
+
+def bench_churn(args):
+    consul = FakeConsul().start()
+    sd = ServiceDiscovery(endpoint=consul.url)
+    services = [Service('churn', '127.0.0.1', 20000 + i)
+                for i in range(args.repeat)]
+    try:
+        results = {
+            'register': summarize(timed(
+                lambda: sd.register(services.pop()), args.repeat))
+        }
+        services = [Service('churn', '127.0.0.1', 20000 + i)
+                    for i in range(args.repeat)]
+        results['unregister'] = summarize(timed(
+            lambda: sd.unregister(services.pop()), args.repeat))
+    finally:
+        sd.close()
+        consul.stop()
+    return results
+
+
+def _listen(application):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    application.listen(port, address='127.0.0.1')
+    return port
+
+
+@tornado.gen.coroutine
+def _load(url, requests, concurrency):
+    """`requests` GETs of `url`, `concurrency` at a time"""
+    client = tornado.httpclient.AsyncHTTPClient()
+    durations = []
+    pending = list(range(requests))
+
+    @tornado.gen.coroutine
+    def worker():
+        while pending:
+            pending.pop()
+            start = time.time()
+            yield client.fetch(url)
+            durations.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    raise tornado.gen.Return(summarize(durations, time.time() - start))
+
+
+def bench_http(args):
+    """/services and /config throughput through the Tornado app"""
+    backends = [_listen(tornado.web.Application(ConfigHandler.routes()))
+                for _ in range(args.instances)]
+    consul = seeded_consul(args.services, args.instances, ports=backends)
+    sd = AsyncServiceDiscovery(endpoint=consul.url, scheme='http')
+    fetcher = app.ConfigFetcher(sd)
+    uncached = app.ResponseCache(fetcher, ttl=0)
+    cached = app.ResponseCache(fetcher, ttl=3600)
+    routes = app.ServiceHandler.routes(sd=sd, fetcher=fetcher,
+                                       cache=cached)
+    routes.append((r'/uncached', app.ServiceHandler,
+                   dict(sd=sd, cache=uncached)))
+    routes.extend(app.ConfigHandler.routes())
+    port = _listen(tornado.web.Application(routes))
+    base = 'http://127.0.0.1:{}'.format(port)
+
+    @tornado.gen.coroutine
+    def run():
+        results = {}
+        # fills the discovery cache and the /services response cache
+        yield tornado.httpclient.AsyncHTTPClient().fetch(base + '/services')
+        results['config'] = yield _load(
+            base + '/config', args.requests, args.concurrency)
+        results['services_cached'] = yield _load(
+            base + '/services', args.requests, args.concurrency)
+        # ttl=0: every request but the one refreshing is served stale,
+        # so time the refresh itself
+        durations = []
+        for _ in range(args.repeat):
+            start = time.time()
+            yield uncached.refresh()
+            durations.append(time.time() - start)
+        results['services_refresh'] = summarize(durations)
+        raise tornado.gen.Return(results)
+
+    try:
+        return tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        sd.close()
+        consul.stop()
+
+
+IMPORTED_MODULES = [
+    'ServiceDiscovery.discovery',
+    'ServiceDiscovery.asyncdiscovery',
+    'ServiceDiscovery.app'
+]
+IMPORT_SCRIPT = """
+import sys, time, json
+start = time.time()
+import {module}
+print(json.dumps([time.time() - start, len(sys.modules)]))
+"""
+
+
+def bench_import(args):
+    """cold import time of the modules, each in a new interpreter"""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    results = {}
+    for module in IMPORTED_MODULES:
+        durations = []
+        for _ in range(args.repeat):
+            out = subprocess.check_output(
+                [sys.executable, '-c', IMPORT_SCRIPT.format(module=module)],
+                env=env)
+            elapsed, modules = json.loads(out.decode('utf-8').splitlines()[-1])
+            durations.append(elapsed)
+        results[module] = summarize(durations)
+        results[module]['modules'] = modules
+    return results
+
+
+BENCHMARKS = [
+    ('import', bench_import),
+    ('lookups', bench_lookups),
+    ('refresh', bench_refresh),
+    ('churn', bench_churn),
+    ('http', bench_http)
+]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--services', type=int, default=100,
+                        help="services in the fake catalog")
+    parser.add_argument('--instances', type=int, default=3,
+                        help="instances per service")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 100, 300],
+                        help="catalog sizes for the refresh benchmark")
+    parser.add_argument('--repeat', type=int, default=20,
+                        help="repetitions of each measure")
+    parser.add_argument('--requests', type=int, default=500,
+                        help="HTTP requests per throughput measure")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="concurrent HTTP requests")
+    parser.add_argument('--only', nargs='+',
+                        choices=[name for name, _ in BENCHMARKS],
+                        help="run only these benchmarks")
+    parser.add_argument('-o', '--output', default='-',
+                        help="JSON output file, - for stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'args': vars(args)
+        },
+        'results': {}
+    }
+    for name, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        log.info("running %s", name)
+        report['results'][name] = bench(args)
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        sys.stdout.write(data + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,8 @@ requirements = [
     'simplejson',
     'psutil',
     'requests',
-    'consul-service-discovery'
+    'consul-service-discovery',
+    'futures; python_version < "3"'
 ]
 
 test_requirements = [
@@ -49,9 +50,13 @@ setup(
     author='Giuseppe Acito',
     author_email='giuseppe.acito@gmail.com',
     url='https://github.com/giupo/ServiceDiscovery',
-    packages=find_packages(exclude=['tests']),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     install_requires=requirements,
+    extras_require={
+        # keep-alive connections to the backends /services fetches
+        'curl': ['pycurl']
+    },
     license="BSD",
     zip_safe=False,
     keywords='ServiceDiscovery',
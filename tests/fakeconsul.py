@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+fakeconsul
+----------
+
+A tiny in-process Consul HTTP API, enough for `ServiceDiscovery`:
+catalog listing, blocking queries, agent (de)registration and health
+checks.
+"""
+
+import re
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+
+def _seconds(wait):
+    """parses a consul duration like '5s' or '1m'"""
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    m = re.match(r'^(\d+)(ms|s|m|h)?$', wait)
+    return float(m.group(1)) * units[m.group(2) or 's']
+
+
+class FakeConsul(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, _Handler)
+        self.instances = {}
+        self.index = 1
+        self.catalog_index = 1
+        self.service_index = {}
+        # check id -> check, as /v1/health/state/any lists them
+        self.checks = {}
+        self.health_index = 1
+        self.requests = []
+        self.changed = threading.Condition()
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self.changed:
+            self.changed.notify_all()
+        self.shutdown()
+        self.server_close()
+
+    def add(self, name, addr='127.0.0.1', port=80, id=None, tags=None,
+            node=None):
+        """registers an instance of `name`, returns its id"""
+        if id is None:
+            id = "{}-{}-{}".format(name, addr, port)
+        with self.changed:
+            self.index += 1
+            if name not in self.service_index:
+                self.catalog_index = self.index
+            self.service_index[name] = self.index
+            self.instances[id] = {
+                'Node': node or addr.split('.')[0],
+                'Address': addr,
+                'ServiceID': id,
+                'ServiceName': name,
+                'ServiceAddress': addr,
+                'ServicePort': int(port),
+                'ServiceTags': list(tags or [])
+            }
+            self.changed.notify_all()
+        return id
+
+    def seed(self, services, instances, addr='127.0.0.1', port=10000):
+        """registers `instances` instances for each of `services`
+        services, named service0, service1, ..."""
+        for i in range(services):
+            for j in range(instances):
+                self.add('service{}'.format(i), addr, port + j)
+
+    def check(self, status, id=None, node=None):
+        """sets the status of the check of the instance `id`, or of the
+        node check of `node`"""
+        with self.changed:
+            if id is not None:
+                instance = self.instances[id]
+                check = {
+                    'Node': instance['Node'],
+                    'CheckID': 'service:{}'.format(id),
+                    'ServiceID': id,
+                    'ServiceName': instance['ServiceName']
+                }
+            else:
+                check = {'Node': node, 'CheckID': 'serfHealth',
+                         'ServiceID': '', 'ServiceName': ''}
+            check['Status'] = status
+            self.index += 1
+            self.health_index = self.index
+            self.checks[(check['Node'], check['CheckID'])] = check
+            self.changed.notify_all()
+
+    def remove(self, id):
+        with self.changed:
+            instance = self.instances.pop(id)
+            name = instance['ServiceName']
+            self.index += 1
+            if self.checks.pop((instance['Node'], 'service:{}'.format(id)),
+                               None):
+                self.health_index = self.index
+            self.service_index[name] = self.index
+            if not self.catalog(name):
+                del self.service_index[name]
+                self.catalog_index = self.index
+            self.changed.notify_all()
+
+    def catalog(self, name=None):
+        if name is not None:
+            return [x for x in self.instances.values()
+                    if x['ServiceName'] == name]
+        ret = {}
+        for x in self.instances.values():
+            tags = ret.setdefault(x['ServiceName'], [])
+            tags.extend(t for t in x['ServiceTags'] if t not in tags)
+        return ret
+
+    def count(self, path):
+        """how many requests hit `path`"""
+        return len([p for p in self.requests if p == path])
+
+    def block(self, current, index, wait):
+        """waits until `current()` moves past `index` or `wait` passes"""
+        with self.changed:
+            if index is not None and current() <= index:
+                self.changed.wait(wait)
+            return current()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, body, index=None, code=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if index is not None:
+            self.send_header('X-Consul-Index', str(index))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self):
+        url = urlparse(self.path)
+        path = re.sub('/+', '/', url.path)
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.server.requests.append(path)
+        return path, query
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_GET(self):
+        server = self.server
+        path, query = self._route()
+        index = query.get('index')
+        index = int(index) if index is not None else None
+        wait = _seconds(query.get('wait', '300s'))
+
+        if path == '/v1/catalog/services':
+            idx = server.block(lambda: server.catalog_index, index, wait)
+            return self._reply(server.catalog(), idx)
+
+        m = re.match('^/v1/catalog/service/(.+)$', path)
+        if m:
+            name = m.group(1)
+            idx = server.block(
+                lambda: server.service_index.get(name, server.index),
+                index, wait)
+            return self._reply(server.catalog(name), idx)
+
+        if path == '/v1/health/state/any':
+            idx = server.block(lambda: server.health_index, index, wait)
+            return self._reply(list(server.checks.values()), idx)
+
+        self._reply('not found', code=404)
+
+    def do_PUT(self):
+        path, _ = self._route()
+        if path == '/v1/agent/service/register':
+            body = self._body()
+            self.server.add(body['Name'], body['Address'],
+                            body.get('Port', 0), id=body['ID'],
+                            tags=body.get('Tags'))
+            return self._reply(None)
+        m = re.match('^/v1/agent/service/deregister/(.+)$', path)
+        if m:
+            return self._deregister(m.group(1))
+        if path == '/v1/txn':
+            return self._txn(self._body())
+        self._reply('not found', code=404)
+
+    def _txn(self, ops):
+        results = []
+        for op in ops:
+            op = op['Service']
+            service = op['Service']
+            if op['Verb'] == 'set':
+                self.server.add(service['Service'], service['Address'],
+                                service.get('Port', 0), id=service['ID'],
+                                tags=service.get('Tags'), node=op['Node'])
+                results.append({'Service': service})
+            elif op['Verb'] == 'delete':
+                if service['ID'] in self.server.instances:
+                    self.server.remove(service['ID'])
+                results.append({})
+        self._reply({'Results': results, 'Errors': None})
+
+    def _deregister(self, id):
+        if id not in self.server.instances:
+            return self._reply('unknown service', code=404)
+        self.server.remove(id)
+        self._reply(None)
@@ -8,5 +8,1262 @@ test_ServiceDiscovery
 Tests for `ServiceDiscovery` module.
 """
 
+import os
+import json
+import time
+import signal
 import unittest
+import requests
+import tornado.gen
+import tornado.web
+import tornado.testing
+from tornado.testing import AsyncHTTPTestCase, gen_test
 from ServiceDiscovery import discovery
+from ServiceDiscovery.cache import TTLCache
+from ServiceDiscovery.balancer import Strategy
+from tests.fakeconsul import FakeConsul
+
+
+def refused(url):
+    """what requests raises when `url` refuses the connection"""
+    from requests.packages.urllib3.exceptions import (MaxRetryError,
+                                                      NewConnectionError)
+    return requests.ConnectionError(MaxRetryError(
+        None, url, NewConnectionError(None, 'refused')))
+
+
+def eventually(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def setUp(self):
+        self.timer = FakeTimer()
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_entries_expire_on_their_own_ttl(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=20)
+        self.timer.now = 15
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.get('b'), 2)
+        self.assertEqual(self.cache.expirations, 1)
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertNotIn('b', self.cache)
+        self.assertIn('a', self.cache)
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_counters(self):
+        self.cache.set('a', 1)
+        self.cache.get('a')
+        self.cache.get('missing')
+        info = self.cache.info()
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 1)
+
+
+class TestServiceDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        self.consul = FakeConsul().start()
+        self.consul.add('web', '10.0.0.1', 8080)
+        self.consul.add('web', '10.0.0.2', 8080)
+        self.consul.add('db', '10.0.0.3', 5432)
+        self.sd = discovery.ServiceDiscovery(endpoint=self.consul.url)
+
+    def tearDown(self):
+        self.sd.close()
+        self.consul.stop()
+
+    def test_miss_fetches_only_that_key(self):
+        services = self.sd.getServices('web')
+        self.assertEqual(sorted(services), [
+            'https://10.0.0.1:8080', 'https://10.0.0.2:8080'])
+        self.assertEqual(self.consul.count('/v1/catalog/services'), 0)
+        self.assertEqual(self.consul.count('/v1/catalog/service/web'), 1)
+        self.sd.getServices('web')
+        self.assertEqual(self.consul.count('/v1/catalog/service/web'), 1)
+        self.assertEqual(self.consul.count('/v1/catalog/service/db'), 0)
+
+    def test_cached_urls_are_computed_once(self):
+        first = self.sd.getServices('web')
+        self.assertIs(self.sd.getServices('web'), first)
+        entry = self.sd.services.peek('web')
+        self.assertIs(entry.urls, first)
+        self.assertEqual(sorted(x.addr for x in entry),
+                         ['10.0.0.1', '10.0.0.2'])
+
+    def test_lookup_by_tags_and_node(self):
+        self.consul.add('api', '10.0.0.5', 80, tags=['v1'], node='n1')
+        self.consul.add('api', '10.0.0.6', 80, tags=['v2'], node='n1')
+        self.consul.add('api', '10.0.0.7', 80, tags=['v2', 'eu'],
+                        node='n2')
+        self.assertEqual(len(self.sd.getServices('api')), 3)
+        self.assertEqual(sorted(self.sd.getServices('api', tags=['v2'])), [
+            'https://10.0.0.6:80', 'https://10.0.0.7:80'])
+        self.assertEqual(self.sd.getServices('api', tags=['v2', 'eu']),
+                         ('https://10.0.0.7:80',))
+        self.assertEqual(self.sd.getServices('api', tags=['v2'], node='n1'),
+                         ('https://10.0.0.6:80',))
+        self.assertEqual(self.sd.getServices('api', tags=['v3']), ())
+        self.assertEqual(self.sd.getService('api', node='n2'),
+                         'https://10.0.0.7:80')
+        self.assertEqual(self.consul.count('/v1/catalog/service/api'), 1)
+
+    def test_only_passing_instances_by_default(self):
+        ok = self.consul.add('api', '10.0.0.5', 80, node='n1')
+        warn = self.consul.add('api', '10.0.0.6', 80, node='n1')
+        down = self.consul.add('api', '10.0.0.7', 80, node='n2')
+        self.consul.check('passing', ok)
+        self.consul.check('warning', warn)
+        self.consul.check('critical', down)
+        self.assertEqual(self.sd.getServices('api'), ('https://10.0.0.5:80',))
+        self.assertEqual(len(self.sd.getServices('api', status='warning')),
+                         2)
+        self.assertEqual(len(self.sd.getServices('api', status='critical')),
+                         3)
+        # read in bulk, once for all lookups
+        self.assertEqual(self.consul.count('/v1/health/state/any'), 1)
+
+        # a failing node check takes all its instances out
+        self.consul.check('critical', node='n1')
+        self.sd.health.clear()
+        self.assertEqual(self.sd.getServices('api', status='warning'), ())
+        self.assertEqual(self.consul.count('/v1/health/state/any'), 2)
+
+    def test_health_outage_backs_off(self):
+        timer = FakeTimer()
+        self.sd.health = TTLCache(maxsize=1, ttl=5, timer=timer)
+        self.consul.check('critical', 'web-10.0.0.1-8080')
+        self.assertEqual(self.sd.getServices('web'),
+                         ('https://10.0.0.2:8080',))
+        reads = []
+
+        def down():
+            reads.append(1)
+            raise IOError('consul down')
+
+        self.sd.consul.health_state = down
+        timer.now = 10
+        for _ in range(100):
+            # filtered with the last health state known
+            self.assertEqual(self.sd.getServices('web'),
+                             ('https://10.0.0.2:8080',))
+        self.assertEqual(len(reads), 1)
+        timer.now = 20
+        self.sd.getServices('web')
+        self.assertEqual(len(reads), 2)
+
+        # none known: nothing filtered, still once per health_ttl
+        self.sd.health.clear()
+        for _ in range(10):
+            self.assertEqual(len(self.sd.getServices('web')), 2)
+        self.assertEqual(len(reads), 3)
+
+    def test_watcher_keeps_services_warm(self):
+        watcher = self.sd.watch(wait=1)
+        self.assertTrue(watcher.wait_synced(5))
+        self.assertTrue(eventually(lambda: 'db' in self.sd.services))
+        requests = len(self.consul.requests)
+        self.assertEqual(self.sd.getServices('db'),
+                         ('https://10.0.0.3:5432',))
+        self.assertEqual(self.sd.getServices('nope'), ())
+        self.assertEqual(len(self.consul.requests), requests)
+
+        self.consul.add('db', '10.0.0.4', 5432)
+        self.assertTrue(eventually(
+            lambda: len(self.sd.getServices('db')) == 2))
+
+        self.consul.add('cache', '10.0.0.5', 6379)
+        self.assertTrue(eventually(
+            lambda: self.sd.getServices('cache') ==
+            ('https://10.0.0.5:6379',)))
+
+    def test_watches_are_capped(self):
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        max_watches=1)
+        try:
+            watcher = sd.watch(wait=1)
+            self.assertTrue(watcher.wait_synced(5))
+            # the first in the catalog, while there was room
+            self.assertTrue(eventually(lambda: 'db' in sd.services))
+            self.assertEqual(watcher._watching(), ['db'])
+
+            # looked up, web takes the place of db
+            self.assertEqual(len(sd.getServices('web')), 2)
+            self.assertTrue(eventually(
+                lambda: watcher._watching() == ['web']))
+            self.consul.add('web', '10.0.0.4', 8080)
+            self.assertTrue(eventually(
+                lambda: len(sd.getServices('web')) == 3))
+            self.assertEqual(len(watcher._watching()), 1)
+        finally:
+            sd.close()
+
+    def test_no_watches(self):
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        max_watches=0)
+        try:
+            self.assertTrue(sd.watch(wait=1).wait_synced(5))
+            self.assertEqual(len(sd.getServices('web')), 2)
+            self.assertEqual(sd.watcher._watching(), [])
+        finally:
+            sd.close()
+
+    def test_unknown_keys_are_negatively_cached(self):
+        self.assertEqual(self.sd.getServices('nope'), ())
+        self.assertEqual(self.sd.getServices('nope'), ())
+        self.assertEqual(self.consul.count('/v1/catalog/service/nope'), 1)
+        self.assertEqual(self.sd.negative_hits, 1)
+
+    def test_refresh_keeps_previous_entry_on_failure(self):
+        self.sd.getServices('db')
+        info = self.sd.consul.info
+
+        def flaky(name, timeout=None):
+            if name == 'db':
+                raise IOError('boom')
+            return info(name, timeout=timeout)
+
+        self.sd.consul.info = flaky
+        self.assertEqual(self.sd._refresh(), ['db'])
+        self.assertEqual(self.sd.getServices('db'),
+                         ('https://10.0.0.3:5432',))
+        self.assertEqual(len(self.sd.getServices('web')), 2)
+
+    def test_call_retries_on_another_instance(self):
+        calls = []
+
+        class Response(object):
+            status_code = 200
+            content = b'{"ok": true}'
+
+            def json(self):
+                return {'ok': True}
+
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                calls.append(url)
+                if url.startswith('https://10.0.0.1'):
+                    raise refused(url)
+                return Response()
+
+        class First(Strategy):
+            def select(self, key, urls):
+                return sorted(urls)[0]
+
+        self.sd.session = Session()
+        self.sd.strategy = First()
+        for _ in range(5):
+            del calls[:]
+            res = self.sd.call('web', '/config', method='POST')
+            self.assertEqual(res, {'ok': True})
+            self.assertEqual(calls[-1], 'https://10.0.0.2:8080/config')
+
+        # consecutive failures ejected the unreachable instance
+        state = self.sd.outliers.state()
+        self.assertTrue(state['https://10.0.0.1:8080']['ejected'])
+        self.assertEqual(self.sd.getServices('web'),
+                         ('https://10.0.0.2:8080',))
+
+    def test_call_raises_the_last_error_when_all_fail(self):
+        calls = []
+
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                calls.append(url)
+                raise requests.ConnectionError('refused by ' + url)
+
+        self.sd.session = Session()
+        with self.assertRaises(requests.ConnectionError) as raised:
+            self.sd.call('web', '/config')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(str(raised.exception), 'refused by ' + calls[-1])
+
+    def test_call_doesnt_replay_sent_requests(self):
+        from requests.packages.urllib3.exceptions import ProtocolError
+        calls = []
+
+        class Session(object):
+            def request(self, method, url, **kwargs):
+                calls.append((method, url))
+                # the instance closed the connection without answering
+                raise requests.ConnectionError(ProtocolError(
+                    'Connection aborted.', IOError('Remote end closed')))
+
+        self.sd.session = Session()
+        self.assertRaises(requests.ConnectionError, self.sd.call, 'web',
+                          '/charge', method='POST')
+        self.assertEqual(len(calls), 1)
+        # sending it twice is the same as once
+        del calls[:]
+        self.assertRaises(requests.ConnectionError, self.sd.call, 'web',
+                          '/charge', method='PUT')
+        self.assertEqual(len(calls), 2)
+
+    def test_power_of_two_choices_prefers_least_loaded(self):
+        from ServiceDiscovery.balancer import PowerOfTwoStrategy
+
+        class Sampler(object):
+            def load(self, url):
+                return 90.0 if url.startswith('https://10.0.0.1') else 10.0
+
+            def stop(self):
+                pass
+
+        self.sd.strategy = PowerOfTwoStrategy(sampler=Sampler())
+        for _ in range(10):
+            self.assertEqual(self.sd.getService('web'),
+                             'https://10.0.0.2:8080')
+
+    def test_round_robin(self):
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        strategy='roundrobin')
+        picked = set(sd.getService('web') for _ in range(2))
+        self.assertEqual(len(picked), 2)
+
+
+class TestOutlierDetector(unittest.TestCase):
+
+    def setUp(self):
+        from ServiceDiscovery.outlier import OutlierDetector
+        self.timer = FakeTimer()
+        self.detector = OutlierDetector(max_failures=2, base_ejection=10,
+                                        timer=self.timer)
+
+    def test_ejection_and_half_open(self):
+        url, other = 'https://a:1', 'https://b:1'
+        urls = (url, other)
+        self.detector.record_failure(url)
+        self.assertEqual(self.detector.filter(urls), urls)
+        self.detector.record_failure(url)
+        self.assertEqual(self.detector.filter(urls), (other,))
+
+        self.timer.now = 11
+        self.assertEqual(self.detector.filter(urls), urls)
+        # a half-open instance is ejected again at the first failure,
+        # for twice as long
+        self.detector.record_failure(url)
+        self.assertEqual(self.detector.state()[url]['ejected_for'], 20)
+
+        self.timer.now = 32
+        self.detector.record_success(url, 0.1)
+        self.detector.record_failure(url)
+        self.assertEqual(self.detector.filter(urls), urls)
+
+    def test_failures_in_flight_dont_extend_the_ejection(self):
+        url = 'https://a:1'
+        for _ in range(8):
+            self.detector.record_failure(url)
+        state = self.detector.state()[url]
+        self.assertEqual(state['ejections'], 1)
+        self.assertEqual(state['ejected_for'], 10)
+
+    def test_all_ejected_keeps_them_all(self):
+        urls = ('https://a:1', 'https://b:1')
+        for url in urls * 2:
+            self.detector.record_failure(url)
+        self.assertTrue(all(self.detector.ejected(url) for url in urls))
+        self.assertEqual(self.detector.ejected_count(), 2)
+        self.assertEqual(self.detector.filter(urls), urls)
+        self.assertEqual(self.detector.filter(()), ())
+
+
+class TestAsyncServiceDiscovery(unittest.TestCase):
+
+    def setUp(self):
+        from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery
+        self.consul = FakeConsul().start()
+        self.consul.add('web', '10.0.0.1', 8080)
+        self.sd = AsyncServiceDiscovery(endpoint=self.consul.url)
+
+    def tearDown(self):
+        self.sd.close()
+        self.consul.stop()
+
+    def run_sync(self, func):
+        import tornado.ioloop
+        return tornado.ioloop.IOLoop.current().run_sync(func)
+
+    def test_lookup_and_registration(self):
+        import tornado.gen
+
+        @tornado.gen.coroutine
+        def scenario():
+            services = yield self.sd.getServices('web')
+            self.assertEqual(services, ('https://10.0.0.1:8080',))
+            service = discovery.Service('db', '10.0.0.3', 5432)
+            yield self.sd.register(service)
+            self.assertEqual(self.consul.catalog('db')[0]['ServiceTags'],
+                             [service.id, 'v1'])
+            yield self.sd.unregister(service)
+            self.assertEqual(self.consul.catalog('db'), [])
+
+        self.run_sync(scenario)
+
+    def closing(self, accepted):
+        """port of a server reading a request then closing the
+        connection without answering, appending to `accepted` on each"""
+        import socket
+        import threading
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(8)
+        self.addCleanup(sock.close)
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except (IOError, OSError):
+                    return
+                accepted.append(conn.recv(65536))
+                conn.close()
+
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+        return sock.getsockname()[1]
+
+    def test_call_doesnt_replay_sent_requests(self):
+        import tornado.gen
+        accepted = []
+        sd = self.sd.__class__(endpoint=self.consul.url, scheme='http')
+        self.addCleanup(sd.close)
+        for _ in range(2):
+            self.consul.add('pay', '127.0.0.1', self.closing(accepted))
+
+        @tornado.gen.coroutine
+        def call(method):
+            try:
+                yield sd.call('pay', '/charge', method=method, body='{}')
+            except Exception as e:
+                raise tornado.gen.Return(e)
+            self.fail('%s /charge answered' % method)
+
+        self.assertIsNotNone(self.run_sync(lambda: call('POST')))
+        self.assertEqual(len(accepted), 1)
+        self.assertIsNotNone(self.run_sync(lambda: call('PUT')))
+        self.assertEqual(len(accepted), 3)
+
+    def test_health_outage_backs_off(self):
+        import tornado.gen
+        consul = self.sd._consul
+        reads = []
+
+        @tornado.gen.coroutine
+        def down(url, *args, **kwargs):
+            if url == self.sd.consul.url_health_state:
+                reads.append(url)
+                raise IOError('consul down')
+            res = yield consul(url, *args, **kwargs)
+            raise tornado.gen.Return(res)
+
+        self.sd._consul = down
+
+        @tornado.gen.coroutine
+        def lookups():
+            for _ in range(100):
+                services = yield self.sd.getServices('web')
+                self.assertEqual(services, ('https://10.0.0.1:8080',))
+
+        self.run_sync(lookups)
+        self.assertEqual(len(reads), 1)
+
+    def test_concurrent_lookups_share_one_health_read(self):
+        from ServiceDiscovery.app import ConfigFetcher
+        self.consul.seed(20, 2)
+        targets = self.run_sync(ConfigFetcher(self.sd).targets)
+        self.assertEqual(len(targets), 41)
+        self.assertEqual(self.consul.count('/v1/health/state/any'), 1)
+        self.assertEqual(self.consul.count('/v1/catalog/service/web'), 1)
+
+
+class TestBatchRegistration(unittest.TestCase):
+
+    def setUp(self):
+        self.consul = FakeConsul().start()
+        self.sd = discovery.ServiceDiscovery(endpoint=self.consul.url)
+        self.services = [discovery.Service('worker', '10.0.0.1', 9000 + i)
+                         for i in range(5)]
+
+    def tearDown(self):
+        self.sd.close()
+        self.consul.stop()
+
+    def check_batch(self, txn):
+        self.assertEqual(self.sd.getServices('worker'), ())
+        results = self.sd.register_many(self.services, txn=txn)
+        self.assertEqual([e for _, e in results], [None] * 5)
+        self.assertEqual(len(self.sd.getServices('worker')), 5)
+
+        results = self.sd.unregister_many(self.services[:2] + [
+            discovery.Service('unknown', '10.0.0.1', 1)], txn=txn)
+        self.assertEqual(len(self.sd.getServices('worker')), 3)
+        return results
+
+    def test_agent_batch(self):
+        results = self.check_batch(txn=False)
+        self.assertIsNone(results[0][1])
+        self.assertIsNotNone(results[2][1])
+
+    def test_txn_batch(self):
+        self.check_batch(txn=True)
+        self.assertEqual(self.consul.count('/v1/txn'), 2)
+
+
+class TestBatchHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.app import BatchHandler
+        from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery
+        self.consul = FakeConsul().start()
+        self.sd = AsyncServiceDiscovery(endpoint=self.consul.url)
+        return tornado.web.Application([
+            (r'/services/batch', BatchHandler, dict(sd=self.sd))])
+
+    def tearDown(self):
+        super(TestBatchHandler, self).tearDown()
+        self.sd.close()
+        self.consul.stop()
+
+    def post(self, body):
+        return self.fetch('/services/batch', method='POST',
+                          body=json.dumps(body))
+
+    def test_register(self):
+        res = self.post({'register': [
+            {'name': 'worker', 'addr': '10.0.0.1', 'port': '9000'}],
+            'txn': True})
+        self.assertEqual(res.code, 200)
+        self.assertEqual(json.loads(res.body)['register'], [
+            {'id': 'worker-10-9000', 'ok': True}])
+        self.assertEqual(len(self.consul.catalog('worker')), 1)
+
+    def test_bad_port(self):
+        res = self.post({'register': [
+            {'name': 'worker', 'addr': '10.0.0.1', 'port': 'http'}],
+            'txn': True})
+        self.assertEqual(res.code, 400)
+        self.assertEqual(self.consul.count('/v1/txn'), 0)
+
+
+class TestSharedCatalog(unittest.TestCase):
+
+    def setUp(self):
+        from ServiceDiscovery.shared import SharedCatalog
+        self.consul = FakeConsul().start()
+        self.consul.add('web', '10.0.0.1', 8080)
+        self.consul.add('web', '10.0.0.2', 8080)
+        self.shared = SharedCatalog(size=64 * 1024)
+        self.writer = discovery.ServiceDiscovery(endpoint=self.consul.url)
+        self.reader = discovery.ServiceDiscovery(endpoint=self.consul.url)
+        self.reader.share(self.shared)
+
+    def tearDown(self):
+        self.writer.close()
+        self.reader.close()
+        self.consul.stop()
+
+    def test_readers_dont_ask_consul(self):
+        self.writer.publish(self.shared)
+        self.assertTrue(eventually(lambda: self.shared.get('web')))
+        self.assertEqual(len(self.reader.getServices('web')), 2)
+        self.assertEqual(self.reader.getServices('nope'), ())
+        self.assertEqual(self.reader.listServices(), ['web'])
+        version = self.shared.version
+
+        self.consul.add('web', '10.0.0.3', 8080)
+        self.assertTrue(eventually(
+            lambda: len(self.reader.getServices('web')) == 3))
+        self.assertGreater(self.shared.version, version)
+        self.assertEqual(self.reader.consul.round_trips, 0)
+
+    def test_unwatched_services_are_published(self):
+        self.consul.add('aaa', '10.0.0.4', 80)
+        self.consul.add('ccc', '10.0.0.5', 80)
+        writer = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                            max_watches=1)
+        self.addCleanup(writer.close)
+        writer.publish(self.shared)
+        self.assertTrue(eventually(lambda: all(
+            self.shared.get(name) for name in ('aaa', 'ccc', 'web'))))
+        self.assertEqual(len(writer.watcher._watching()), 1)
+        for _ in range(4):
+            reader = discovery.ServiceDiscovery(endpoint=self.consul.url)
+            reader.share(self.shared)
+            self.assertEqual(reader.getServices('ccc'),
+                             ('https://10.0.0.5:80',))
+            self.assertEqual(reader.consul.round_trips, 0)
+
+    def test_forked_reader(self):
+        import os
+        self.writer.publish(self.shared)
+        self.assertTrue(eventually(lambda: self.shared.get('web')))
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            os.write(w, ','.join(self.shared.get('web').urls).encode())
+            os._exit(0)
+        os.close(w)
+        urls = os.read(r, 4096).decode()
+        os.close(r)
+        os.waitpid(pid, 0)
+        self.assertEqual(sorted(urls.split(',')), [
+            'https://10.0.0.1:8080', 'https://10.0.0.2:8080'])
+
+
+class TestSnapshotFile(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.consul = FakeConsul().start()
+        self.consul.add('web', '10.0.0.1', 8080)
+        self.consul.add('db', '10.0.0.3', 5432)
+        self.dir = tempfile.mkdtemp()
+        self.path = self.dir + '/catalog'
+
+    def tearDown(self):
+        import shutil
+        self.consul.stop()
+        shutil.rmtree(self.dir)
+
+    def persisted(self):
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        snapshot=self.path)
+        try:
+            sd._refresh()
+            sd.persist(interval=0.01)
+            self.assertTrue(eventually(lambda: sd.snapshot_age is not None))
+        finally:
+            sd.close()
+
+    def test_warm_start_and_outage(self):
+        self.persisted()
+        sd = discovery.ServiceDiscovery(endpoint='http://127.0.0.1:1',
+                                        snapshot=self.path)
+        try:
+            self.assertLess(sd.snapshot_age, 5)
+            self.assertEqual(sd.getServices('web'),
+                             ('https://10.0.0.1:8080',))
+            self.assertEqual(sd.getServices('nope'), ())
+            # the background refresh failed, consul is still out
+            self.assertTrue(eventually(
+                lambda: not sd._catching_up.is_alive()))
+            self.assertEqual(sd.getServices('db'),
+                             ('https://10.0.0.3:5432',))
+        finally:
+            sd.close()
+
+    def test_catch_up_with_one_worker(self):
+        self.persisted()
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        snapshot=self.path, workers=1)
+        try:
+            self.assertEqual(sd.getServices('web'),
+                             ('https://10.0.0.1:8080',))
+            self.assertTrue(eventually(lambda: sd._warm))
+        finally:
+            sd.close()
+
+    def test_shared_readers_dont_catch_up(self):
+        from ServiceDiscovery.shared import SharedCatalog
+        self.persisted()
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        snapshot=self.path)
+        sd.share(SharedCatalog(size=64 * 1024))
+        try:
+            self.assertEqual(sd.getServices('web', status='critical'),
+                             ('https://10.0.0.1:8080',))
+            self.assertIsNone(sd._catching_up)
+            self.assertEqual(sd.consul.round_trips, 0)
+        finally:
+            sd.close()
+
+    def test_watched_discovery_is_warm(self):
+        self.persisted()
+        self.consul.remove('web-10.0.0.1-8080')
+        self.consul.add('web', '10.0.0.9', 8080)
+        sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                        snapshot=self.path, watch=True,
+                                        max_watches=1)
+        try:
+            self.assertTrue(sd.watcher.wait_synced(5))
+            self.assertTrue(sd.warm)
+            self.assertTrue(eventually(
+                lambda: sd.services.peek('web') is not None))
+            # dropped from the cache: consul has it, not the snapshot
+            sd.services.invalidate('web')
+            self.assertEqual(sd.getServices('web'),
+                             ('https://10.0.0.9:8080',))
+        finally:
+            sd.close()
+
+    def test_max_staleness(self):
+        self.persisted()
+        sd = discovery.ServiceDiscovery(endpoint='http://127.0.0.1:1',
+                                        snapshot=self.path, max_staleness=0)
+        try:
+            self.assertRaises(Exception, sd.getServices, 'web')
+        finally:
+            sd.close()
+
+
+class TestConfigHandler(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.controllers import ConfigHandler
+        return tornado.web.Application(ConfigHandler.routes())
+
+    def test_conditional_get(self):
+        res = self.fetch('/config')
+        self.assertEqual(res.code, 200)
+        etag = res.headers['Etag']
+        res = self.fetch('/config', headers={'If-None-Match': etag})
+        self.assertEqual(res.code, 304)
+
+        from ServiceDiscovery.controllers import config
+        ttl = config.get('ServiceDiscovery', 'services_ttl')
+        config.set('ServiceDiscovery', 'services_ttl', '1.0')
+        try:
+            res = self.fetch('/config', headers={'If-None-Match': etag})
+            self.assertEqual(res.code, 200)
+        finally:
+            config.set('ServiceDiscovery', 'services_ttl', ttl)
+
+    @gen_test
+    def test_fetcher_reuses_config_on_304(self):
+        from ServiceDiscovery.app import ConfigFetcher
+        fetcher = ConfigFetcher(sd=None, http_client=self.http_client)
+        first, _ = yield fetcher.fetch(self.get_url('/'))
+        second, _ = yield fetcher.fetch(self.get_url('/'))
+        self.assertEqual(first, second)
+        self.assertEqual(self.get_url('/config'), list(fetcher.configs)[0])
+
+
+class TestDrainingApplication(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.controllers import HealthHandler
+        from ServiceDiscovery.supervisor import DrainingApplication
+        self.application = DrainingApplication(HealthHandler.routes())
+        return self.application
+
+    @gen_test
+    def test_aborted_requests_arent_in_flight(self):
+        from tornado.tcpclient import TCPClient
+        res = yield self.http_client.fetch(self.get_url('/health'))
+        self.assertEqual(res.code, 200)
+        self.assertEqual(self.application.inflight, 0)
+
+        # the client leaves in the middle of the body
+        stream = yield TCPClient().connect('127.0.0.1', self.get_http_port())
+        yield stream.write(b'POST /health HTTP/1.1\r\nHost: x\r\n'
+                           b'Content-Length: 100\r\n\r\n0123456789')
+        for _ in range(100):
+            if self.application.inflight:
+                break
+            yield tornado.gen.sleep(0.01)
+        self.assertEqual(self.application.inflight, 1)
+        stream.close()
+        for _ in range(100):
+            if not self.application.inflight:
+                break
+            yield tornado.gen.sleep(0.01)
+        self.assertEqual(self.application.inflight, 0)
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def record(self, line):
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+
+    def events(self):
+        with open(self.path) as f:
+            return f.read().split()
+
+    def worker(self, task_id):
+        stopped = []
+        signal.signal(signal.SIGTERM, lambda sig, frame: stopped.append(1))
+        self.record('start{}:{}'.format(task_id, os.getpid()))
+        while not stopped:
+            time.sleep(0.01)
+        self.record('drain{}'.format(task_id))
+
+    def test_respawn_then_deregister_before_draining(self):
+        from ServiceDiscovery.supervisor import Supervisor
+        pid = os.fork()
+        if pid == 0:
+            try:
+                Supervisor(self.worker, nproc=2,
+                           register=lambda: self.record('register'),
+                           deregister=lambda: self.record('deregister'),
+                           drain_timeout=2).run()
+            finally:
+                os._exit(0)
+
+        self.assertTrue(eventually(lambda: len(self.events()) == 3))
+        crashed = [e for e in self.events() if e.startswith('start0:')][0]
+        os.kill(int(crashed.split(':')[1]), signal.SIGKILL)
+        self.assertTrue(eventually(lambda: len(self.events()) == 4))
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+        events = self.events()
+        self.assertEqual(events[0], 'register')
+        self.assertEqual(sorted(e[:6] for e in events[1:4]),
+                         ['start0', 'start0', 'start1'])
+        self.assertEqual(events[4], 'deregister')
+        self.assertEqual(sorted(events[5:]), ['drain0', 'drain1'])
+
+    def test_failed_registration_aborts(self):
+        from ServiceDiscovery.supervisor import Supervisor
+
+        def register():
+            self.record('register')
+            raise refused('http://127.0.0.1:1/v1/agent/service/register')
+
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                Supervisor(self.worker, nproc=2, register=register,
+                           deregister=lambda: self.record('deregister'),
+                           drain_timeout=2).run()
+            except requests.ConnectionError:
+                code = 3
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 3)
+        self.assertEqual(self.events(), ['register'])
+
+
+class TestResponseCache(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery import app
+
+        class Fetcher(object):
+            calls = 0
+
+            @tornado.gen.coroutine
+            def fetch_all(self, tags=(), node=None):
+                Fetcher.calls += 1
+                yield tornado.gen.sleep(0.2)
+                raise tornado.gen.Return(({'n': Fetcher.calls}, {}))
+
+        self.fetcher = Fetcher
+        self.cache = app.ResponseCache(Fetcher(), ttl=60)
+        return tornado.web.Application([
+            (r'/services', app.ServiceHandler,
+             dict(sd=None, cache=self.cache))
+        ])
+
+    @tornado.gen.coroutine
+    def get(self):
+        res = yield self.http_client.fetch(self.get_url('/services'))
+        raise tornado.gen.Return((res.headers['X-Cache'],
+                                  int(res.headers['Age']),
+                                  json.loads(res.body)))
+
+    @gen_test
+    def test_miss_hit_then_stale_with_one_refresh(self):
+        res = yield self.get()
+        self.assertEqual(res, ('MISS', 0, {'n': 1}))
+        res = yield self.get()
+        self.assertEqual(res, ('HIT', 0, {'n': 1}))
+
+        self.cache.updated -= 100
+        stale = yield [self.get(), self.get()]
+        self.assertEqual(stale, [('STALE', 100, {'n': 1})] * 2)
+        while self.cache.refreshing:
+            yield tornado.gen.sleep(0.01)
+        self.assertEqual(self.fetcher.calls, 2)
+        res = yield self.get()
+        self.assertEqual(res, ('HIT', 0, {'n': 2}))
+
+    @gen_test
+    def test_etag_is_computed_once(self):
+        res = yield self.http_client.fetch(self.get_url('/services'))
+        etag = self.cache.etag
+        self.assertEqual(res.headers['Etag'], etag)
+        import hashlib
+        sha1 = hashlib.sha1
+        hashlib.sha1 = None
+        try:
+            res = yield self.http_client.fetch(
+                self.get_url('/services'), raise_error=False,
+                headers={'If-None-Match': etag})
+        finally:
+            hashlib.sha1 = sha1
+        self.assertEqual(res.code, 304)
+
+
+class TestStatsHistory(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.stats import StatsHandler, StatsSampler
+        self.sampler = StatsSampler(interval=60)
+        now = time.time()
+        for age, cpu in ((120, 99.0), (30, 10.0), (20, 30.0), (10, 20.0)):
+            self.sampler.samples.append({
+                'time': now - age, 'cpu': cpu, 'memory_percent': 50.0,
+                'memory_used': 1, 'memory_available': 1, 'index': cpu})
+        return tornado.web.Application(StatsHandler.routes(self.sampler))
+
+    def tearDown(self):
+        self.sampler.stop()
+        super(TestStatsHistory, self).tearDown()
+
+    def test_window(self):
+        res = self.fetch('/stats/history?window=1m')
+        self.assertEqual(res.code, 200)
+        history = json.loads(res.body)
+        self.assertEqual(history['window'], '1m')
+        # the one of 2 minutes ago is out, the one taken on start is in
+        self.assertEqual(history['samples'], 4)
+        self.assertEqual(history['memory_used']['min'], 1)
+
+    def test_bad_window(self):
+        self.assertEqual(self.fetch('/stats/history?window=2m').code, 400)
+
+
+class TestMetrics(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.controllers import MetricsHandler, log_request
+        from ServiceDiscovery.metrics import Registry, REQUESTS
+        self.consul = FakeConsul().start()
+        self.sd = discovery.ServiceDiscovery(endpoint=self.consul.url)
+        registry = Registry()
+        registry.register(REQUESTS)
+        MetricsHandler.routes(registry, sd=self.sd)
+        return tornado.web.Application(
+            MetricsHandler.routes(registry, sd=self.sd),
+            log_function=log_request)
+
+    def tearDown(self):
+        super(TestMetrics, self).tearDown()
+        self.sd.close()
+        self.consul.stop()
+
+    def test_exposition(self):
+        self.sd.getServices('nope')
+        self.fetch('/metrics')
+        res = self.fetch('/metrics')
+        self.assertEqual(res.code, 200)
+        self.assertTrue(res.headers['Content-Type'].startswith('text/plain'))
+        lines = res.body.decode('utf-8').splitlines()
+        # registered twice, exposed once
+        self.assertEqual(lines.count(
+            '# TYPE servicediscovery_consul_requests_total counter'), 1)
+        # the catalog lookup and the health read
+        self.assertIn('servicediscovery_consul_requests_total 2.0', lines)
+        self.assertIn('servicediscovery_cache_size{cache="negative"} 1.0',
+                      lines)
+        self.assertTrue(any(
+            line.startswith('http_requests_total{handler="MetricsHandler",'
+                            'method="GET",code="200"}') for line in lines))
+
+
+class TestServerTiming(unittest.TestCase):
+
+    def test_only_the_slowest_backends(self):
+        from ServiceDiscovery.app import server_timing
+        timings = dict(('http://10.0.0.{}:80'.format(i), i / 1000.0)
+                       for i in range(1, 201))
+        header = server_timing(timings, slowest=2)
+        self.assertEqual(header, ', '.join([
+            'backends;desc="200 backends";dur=200.0',
+            'config;desc="http://10.0.0.200:80";dur=200.0',
+            'config;desc="http://10.0.0.199:80";dur=199.0']))
+        self.assertIsNone(server_timing({}))
+
+
+class TestConfigFetcher(AsyncHTTPTestCase):
+
+    def get_app(self):
+        test = self
+        # port -> seconds its /config takes
+        self.delays = {}
+        self.servers = []
+        self.inflight = 0
+        self.most_inflight = 0
+
+        class Backend(tornado.web.RequestHandler):
+            @tornado.gen.coroutine
+            def get(self):
+                port = self.request.connection.stream.socket.getsockname()[1]
+                test.inflight += 1
+                test.most_inflight = max(test.most_inflight, test.inflight)
+                try:
+                    yield tornado.gen.sleep(test.delays.get(port, 0))
+                finally:
+                    test.inflight -= 1
+                self.finish({'config': {'port': port}})
+
+        return tornado.web.Application([(r'/config', Backend)])
+
+    def backend(self, delay):
+        """url of another server of the app, answering in `delay`s"""
+        from tornado.httpserver import HTTPServer
+        from tornado.testing import bind_unused_port
+        sock, port = bind_unused_port()
+        server = HTTPServer(self._app)
+        server.add_sockets([sock])
+        self.servers.append(server)
+        self.delays[port] = delay
+        return 'http://127.0.0.1:{}'.format(port)
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        super(TestConfigFetcher, self).tearDown()
+
+    @tornado.gen.coroutine
+    def drained(self):
+        while self.inflight:
+            yield tornado.gen.sleep(0.01)
+
+    def refused(self):
+        from tornado.testing import bind_unused_port
+        sock, port = bind_unused_port()
+        sock.close()
+        return 'http://127.0.0.1:{}'.format(port)
+
+    def fetcher(self, targets, concurrency=16, timeout=0.6):
+        from ServiceDiscovery.app import ConfigFetcher
+
+        class SD(object):
+            @tornado.gen.coroutine
+            def listServices(self):
+                raise tornado.gen.Return(sorted(targets))
+
+            @tornado.gen.coroutine
+            def getServices(self, name, tags=(), node=None):
+                raise tornado.gen.Return((targets[name],))
+
+        return ConfigFetcher(SD(), http_client=self.http_client,
+                             concurrency=concurrency, timeout=timeout)
+
+    @gen_test
+    def test_concurrent_fetches_and_failures(self):
+        fetcher = self.fetcher({
+            'ok': self.backend(0.4),
+            'slow': self.backend(1),
+            'down': self.refused()
+        })
+        start = time.time()
+        ret, timings = yield fetcher.fetch_all()
+        elapsed = time.time() - start
+        configs = dict((name, list(urls.values())[0])
+                       for services in ret.values()
+                       for name, urls in services.items())
+        self.assertEqual(configs['slow'], 'Timeout')
+        self.assertEqual(configs['down'], 'None')
+        self.assertIn('port', configs['ok'])
+        self.assertEqual(len(timings), 3)
+        # as long as the slowest fetch, not all of them
+        self.assertGreaterEqual(elapsed, 0.6)
+        self.assertLess(elapsed, 0.9)
+        yield self.drained()
+
+    @gen_test
+    def test_concurrency_is_bounded(self):
+        url = self.backend(0.1)
+        fetcher = self.fetcher({}, concurrency=2)
+        start = time.time()
+        results = yield [fetcher.fetch(url) for _ in range(6)]
+        self.assertEqual(self.most_inflight, 2)
+        self.assertTrue(all('port' in data for data, _ in results))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+
+
+class TestServicesStream(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery import app
+        from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery
+        self.consul = FakeConsul().start()
+        # this very app is the only backend
+        self.consul.add('web', '127.0.0.1', self.get_http_port())
+        self.sd = AsyncServiceDiscovery(endpoint=self.consul.url,
+                                        scheme='http')
+        routes = app.ServiceHandler.routes(sd=self.sd)
+        routes.extend(app.ConfigHandler.routes())
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        super(TestServicesStream, self).tearDown()
+        self.sd.close()
+        self.consul.stop()
+
+    def test_ndjson(self):
+        chunks = []
+        res = self.fetch('/services?stream=1',
+                         streaming_callback=chunks.append)
+        self.assertEqual(res.headers['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(chunks).decode('utf-8').splitlines()
+        self.assertEqual(len(lines), 1)
+        record = json.loads(lines[0])
+        self.assertEqual(record['service'], 'web')
+        self.assertIn('nproc', record['config'])
+
+
+class TestWatch(AsyncHTTPTestCase):
+
+    def get_app(self):
+        from ServiceDiscovery.asyncdiscovery import AsyncServiceDiscovery
+        from ServiceDiscovery.events import CatalogEvents, WatchHandler
+        self.consul = FakeConsul().start()
+        self.consul.add('web', '10.0.0.1', 80)
+        self.sd = AsyncServiceDiscovery(endpoint=self.consul.url,
+                                        scheme='http')
+        self.events = CatalogEvents(self.sd, interval=0.02)
+        return tornado.web.Application([
+            (r'/services/watch', WatchHandler,
+             dict(events=self.events, heartbeat=0.1, max_watchers=2))
+        ])
+
+    def tearDown(self):
+        self.events.stop()
+        super(TestWatch, self).tearDown()
+        self.sd.close()
+        self.consul.stop()
+
+    def watch(self, chunks, **headers):
+        return self.http_client.fetch(
+            self.get_url('/services/watch'), headers=headers,
+            streaming_callback=chunks.append, request_timeout=1)
+
+    @tornado.gen.coroutine
+    def until(self, chunks, text):
+        for _ in range(200):
+            if text in b''.join(chunks).decode('utf-8'):
+                return
+            yield tornado.gen.sleep(0.01)
+        self.fail('%r never came' % text)
+
+    @gen_test(timeout=10)
+    def test_deltas_resume_and_cap(self):
+        first = []
+        streams = [self.watch(first)]
+        yield self.until(first, 'event: snapshot')
+        text = b''.join(first).decode('utf-8')
+        start = text.split('event: snapshot')[0].split('id: ')[-1].strip()
+        yield self.until(first, '10.0.0.1')
+
+        self.consul.add('web', '10.0.0.2', 80, id='web2')
+        yield self.until(first, '"web2"')
+        yield self.until(first, ': heartbeat')
+
+        # back from the snapshot: only what was missed, no snapshot
+        resumed = []
+        streams.append(self.watch(resumed, **{'Last-Event-ID': start}))
+        yield self.until(resumed, '"web2"')
+        self.assertNotIn(b'event: snapshot', b''.join(resumed))
+
+        res = yield self.http_client.fetch(self.get_url('/services/watch'),
+                                           raise_error=False)
+        self.assertEqual(res.code, 503)
+        for stream in streams:
+            try:
+                yield stream
+            except Exception:
+                pass
+
+    @gen_test(timeout=10)
+    def test_close_ends_the_streams(self):
+        self.assertIsNone(self.events.epoch)
+        chunks = []
+        stream = self.watch(chunks)
+        yield self.until(chunks, 'event: snapshot')
+        self.assertIn(format(os.getpid(), 'x'), self.events.epoch)
+        self.events.close()
+        res = yield stream
+        self.assertEqual(res.code, 200)
+        res = yield self.http_client.fetch(self.get_url('/services/watch'),
+                                           raise_error=False)
+        self.assertEqual(res.code, 503)
+
+
+class TestCatalogEvents(tornado.testing.AsyncTestCase):
+
+    def setUp(self):
+        from ServiceDiscovery.events import CatalogEvents
+        super(TestCatalogEvents, self).setUp()
+        self.consul = FakeConsul().start()
+        for name in ('api', 'db', 'web'):
+            self.consul.add(name, '10.0.0.1', 80)
+        self.sd = discovery.ServiceDiscovery(endpoint=self.consul.url,
+                                             scheme='http', max_watches=1)
+        self.events = CatalogEvents(self.sd)
+        # polled by hand
+        self.events.start()
+        self.events.stop()
+
+    def tearDown(self):
+        self.sd.close()
+        self.consul.stop()
+        super(TestCatalogEvents, self).tearDown()
+
+    def deltas(self):
+        return [json.loads(data) for _, data in self.events.events]
+
+    def test_only_the_catalog_removes(self):
+        self.assertTrue(eventually(lambda: all(
+            self.sd.services.peek(x) is not None
+            for x in ('api', 'db', 'web'))))
+        self.events.poll()
+        self.assertEqual(sorted(json.loads(self.events.snapshot())),
+                         ['api', 'db', 'web'])
+
+        # dropped from the cache is not gone from the catalog
+        self.sd.services.invalidate('web')
+        self.consul.add('api', '10.0.0.2', 80, id='api2')
+        self.assertTrue(eventually(
+            lambda: len(self.sd.services.peek('api') or ()) == 2))
+        self.events.poll()
+        self.assertEqual(self.deltas()[-1]['added'][0]['id'], 'api2')
+        self.assertFalse([x for x in self.deltas() if x['removed']])
+        self.assertIn('web', json.loads(self.events.snapshot()))
+
+        self.consul.remove('db-10.0.0.1-80')
+        self.assertTrue(eventually(
+            lambda: 'db' not in self.sd.watcher.services))
+        self.events.poll()
+        self.assertEqual(self.deltas()[-1],
+                         {'service': 'db', 'added': [],
+                          'removed': ['db-10.0.0.1-80'], 'changed': []})
+        self.assertNotIn('db', json.loads(self.events.snapshot()))